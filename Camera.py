@@ -1,10 +1,17 @@
 import logging
 import math
 import threading
+import time
 
 
 from geopy.distance import geodesic
 
+from Latency import LatencyEstimator
+from Scheduler import DeadlineScheduler
+from Supervisor import ConnectionSupervisor
+from Vapix import VapixController
+from Visibility import VisibilityMask
+
 logging.basicConfig(level=logging.DEBUG)  # This line prevents the vapix API from stealing the root logger
 from sensecam_control import vapix_control, vapix_config
 
@@ -53,13 +60,18 @@ class Camera:
                  config: dict,
                  actually_move=True,
                  disk_name='SD_DISK',
-                 profile_name=None):
+                 profile_name=None,
+                 supervisor: ConnectionSupervisor = None,
+                 scheduler: DeadlineScheduler = None):
         """
         Initialize the values and convert to decimal if needed
         :param config: the configuration dictionary
         :param actually_move: Whether the camera should actually move or use the NullController class
         :param disk_name: the name of the disk to use for recordings
         :param profile_name: the name of the recording profile to use (None is fine)
+        :param supervisor: the ConnectionSupervisor to retry camera calls with (None = create one from the config)
+        :param scheduler: the DeadlineScheduler to run deferred deactivations on. Its owner must run it. Only needed for
+         Camera.deactivate with a delay
         :return: None
         """
         self.lat = float(config['camera']['lat'])
@@ -77,7 +89,12 @@ class Camera:
         self.move = actually_move
         self.disk_name = disk_name
         self.profile_name = profile_name
-        if self.move:
+        if self.move and config['camera']['controller'] == 'pooled':
+            # One controller with keep-alive sessions handles both PTZ and recordings
+            self.controller = self.media = VapixController(config['camera_login']['ip'],
+                                                           config['camera_login']['username'],
+                                                           config['camera_login']['password'])
+        elif self.move:
             self.controller = vapix_control.CameraControl(config['camera_login']['ip'],
                                                           config['camera_login']['username'],
                                                           config['camera_login']['password'])
@@ -93,6 +110,26 @@ class Camera:
         self.current_zoom = 0
         self.current_recording_name = ''
         self.deactivating = False
+        self.scheduler = scheduler
+        self.deactivation = None  # The Deadline of a deferred deactivation
+        if supervisor is None:
+            supervisor = ConnectionSupervisor(**config['supervisor'])
+        self.supervisor = supervisor
+        self.latency = LatencyEstimator(config['camera']['lead'],
+                                        auto=config['camera']['auto_lead'],
+                                        slew_rate=config['camera']['slew_rate'],
+                                        max_lead=config['camera']['max_lead'])
+        self.lead = self.latency.lead()
+        self.tracking = False  # Whether the camera's current position came from a tracking move
+        visibility = config['camera']['visibility']
+        self.visibility = VisibilityMask(visibility['tilt_min'], visibility['tilt_max'],
+                                         visibility['obstructions'], visibility['resolution'])
+        self.hidden_since = None  # When the drone went out of view (None = it is visible)
+        self.hidden_time = 0  # Total seconds the drone has been out of view
+        self.moves_suppressed = 0  # Moves we didn't send because the drone was out of view
+        self.suppressed_position = None  # The (pan, tilt, zoom) of the last suppressed move, where the camera would be
+        self.paused_since = None  # When the recording was paused because the drone was out of view
+        self.paused_time = 0  # Total seconds the recording has been paused
 
     def update(self):
         """
@@ -105,9 +142,11 @@ class Camera:
         log.debug(f'updated (pan, tilt, horiz_distance, vert_distance, distance, zoom)'
                   f' {self.heading_xy}, {self.heading_z}, {self.dist_xy}, {self.dist_z}, {self.dist}, {self.zoom}')
 
-    def calculate_heading_directions(self):
+    def calculate_heading_directions(self, drone_loc=None, lead_time=None):
         """
         A function to calculate the heading and distances, while also leading the camera.
+        :param drone_loc: the location and velocity to calculate for (None = self.drone_loc)
+        :param lead_time: the amount of seconds to lead by (None = self.lead)
         :return: The heading
         """
         log = self.log.getChild("calculate_heading")
@@ -115,13 +154,18 @@ class Camera:
 
         camera_lat_long = [self.lat, self.long]
 
+        if drone_loc is None:
+            drone_loc = self.drone_loc
+        if lead_time is None:
+            lead_time = self.lead
+
         # Unpack drone_loc
-        lat = self.drone_loc[0]
-        long = self.drone_loc[1]
-        alt = self.drone_loc[2]
-        vx = self.drone_loc[3]
-        vy = self.drone_loc[4]
-        vz = self.drone_loc[5]
+        lat = drone_loc[0]
+        long = drone_loc[1]
+        alt = drone_loc[2]
+        vx = drone_loc[3]
+        vy = drone_loc[4]
+        vz = drone_loc[5]
 
         # Convert coordinates to arc lengths
         first_lat = camera_lat_long[0] * pi_c
@@ -163,8 +207,6 @@ class Camera:
                   f"dist_y {y} "
                   f"dist_z {z}")
 
-        lead_time = self.config['camera']['lead']
-
         # Lead the camera (calculate new relative x, y, and z)
         # We do north/east/up, I guess DroneKit does north/east/down? This can be changed easily
         x += lead_time * vx
@@ -191,12 +233,18 @@ class Camera:
 
         return heading_xy / pi_c, heading_z / pi_c, dist_xy, dist_z
 
-    def calculate_zoom(self):
+    def calculate_zoom(self, dist_xy=None, dist_z=None):
         """
         A function to calculate the zoom for the camera.
+        :param dist_xy: the horizontal distance to the drone (None = self.dist_xy)
+        :param dist_z: the vertical distance to the drone (None = self.dist_z)
         :return: the absolute distance to the drone, and the necessary zoom value
         """
-        dist = math.sqrt(self.dist_xy ** 2 + self.dist_z ** 2)
+        if dist_xy is None:
+            dist_xy = self.dist_xy
+        if dist_z is None:
+            dist_z = self.dist_z
+        dist = math.sqrt(dist_xy ** 2 + dist_z ** 2)
         # Determine the maximum relative "size" of the drone relative to the camera
         max_dimension = max([i for i in [self.config['drone']['x'],
                                          self.config['drone']['y'],
@@ -206,29 +254,139 @@ class Camera:
         zoom *= 1 / self.config['camera']['zoom_error']  # Account for the "fudge factor"
         return dist, zoom
 
-    def move_camera(self, drone_loc):
+    def move_camera(self, drone_loc, timestamp=None):
         """
         A function to send the command to pan, tilt, and zoom to the camera over whatever protocol we end up using
         :param drone_loc: the location and velocity of the drone (lat, long, alt, vx, vy, vz)
+        :param timestamp: when the drone_loc was produced (seconds since the epoch), used to measure telemetry age.
+         Only pass it for a newly received fix (None = drone_loc is the same fix as last time)
         :return: none
         """
         log = self.log.getChild("move_camera")  # Get log handler
         self.drone_loc = drone_loc  # The new position of the drone
+        if timestamp is not None:
+            self.latency.observe_telemetry(timestamp)
+        self.lead = self.latency.lead()  # Lead by how far behind the drone we are measured to be
+        log.debug(f'latency compensation: {self.latency.report()}')
+        self.cancel_deactivation()  # The drone is back, so don't deactivate from under it
         self.update()  # Update our data about where we should go based on self.drone_loc
+        if not self._check_visible():
+            return  # Hold position, the camera can't see the drone anyway
         if not self.activated:
-            while True:
-                # Start recording
-                rc_name, out = self.media.start_recording(self.disk_name, profile=self.profile_name)
-                if out == 1:
-                    log.error(f'failed to start recording! error: {rc_name}')
-                    continue
+            self._start_recording()
+        self._move()
+
+    def pre_slew(self, plan):
+        """
+        Point the camera at the start of a flight plan without recording, so it is already there at takeoff
+        :param plan: the FlightPlan
+        :return: none
+        """
+        log = self.log.getChild("pre_slew")
+        self.heading_xy, self.heading_z, self.zoom = plan.first()
+        log.info(f"pre-slewing to the takeoff point (p, t, z) {self.heading_xy}, {self.heading_z}, {self.zoom}")
+        self._move(track=False)
 
-                self.current_recording_name = rc_name  # Keep track of the recording name for management purposes
-                break
+    def follow_plan(self, plan, now):
+        """
+        Point the camera where the flight plan says the drone should be. Used when telemetry is late or missing.
+        :param plan: the FlightPlan
+        :param now: the current time (seconds since the epoch)
+        :return: whether the plan covers the current time
+        """
+        log = self.log.getChild("follow_plan")
+        pointing = plan.at(now + self.lead)
+        if pointing is None:
+            return False
+        self.cancel_deactivation()
+        self.heading_xy, self.heading_z, self.zoom = pointing
+        log.debug(f"following flight plan to (p, t, z) {self.heading_xy}, {self.heading_z}, {self.zoom}")
+        if not self._check_visible():
+            return True
+        if not self.activated:
+            self._start_recording()
+        self._move()
+        return True
 
+    def _check_visible(self):
+        """
+        Check self.heading_xy and self.heading_z against the visibility mask, keeping track of the time the drone is
+        out of view and pausing the recording if it is out of view for too long. Should not be called by user.
+        :return: whether the drone is visible
+        """
+        log = self.log.getChild("visibility")
+        now = time.monotonic()
+        if self.visibility.visible(self.heading_xy, self.heading_z):
+            if self.hidden_since is not None:
+                log.info(f"drone is visible again after {round(now - self.hidden_since, 2)}s")
+                self.hidden_time += now - self.hidden_since
+                self.hidden_since = None
+            if self.paused_since is not None:  # The recording is restarted by the caller
+                self.paused_time += now - self.paused_since
+                self.paused_since = None
+            return True
+
+        if self.hidden_since is None:
+            log.info(f"drone is out of view at (p, t) {self.heading_xy}, {self.heading_z}, holding position")
+            self.hidden_since = now
+            self.suppressed_position = (self.current_pan, self.current_tilt, self.current_zoom)
+        # Only count the moves _move would actually have sent, from where the camera would be if it had sent them
+        if self._significant_move(*self.suppressed_position):
+            self.moves_suppressed += 1
+            self.suppressed_position = (self.heading_xy, self.heading_z, self.zoom)
+        pause_after = self.config['camera']['visibility']['pause_recording_after']
+        if self.activated and pause_after and now - self.hidden_since >= pause_after:
+            log.info(f"drone has been out of view for {pause_after}s, pausing the recording")
+            # Only try once so the tick isn't held up. If it fails, we try again on a later tick after backing off
+            if self._stop_recording(wait=False):
+                self.activated = False
+                self.paused_since = now
+        return False
+
+    def visibility_report(self):
+        """
+        :return: a string describing how much the visibility mask has saved
+        """
+        hidden_time = self.hidden_time
+        paused_time = self.paused_time
+        now = time.monotonic()
+        if self.hidden_since is not None:
+            hidden_time += now - self.hidden_since
+        if self.paused_since is not None:
+            paused_time += now - self.paused_since
+        saved_bytes = paused_time * self.config['camera']['visibility']['bitrate']
+        return (f"drone out of view for {round(hidden_time, 2)}s, {self.moves_suppressed} moves suppressed, "
+                f"recording paused for {round(paused_time, 2)}s (~{round(saved_bytes / 1e6, 1)} MB saved)")
+
+    def _start_recording(self):
+        """
+        Start recording and activate the camera. Should not be called by user.
+        :return: none
+        """
+        log = self.log.getChild("start_recording")
+        # Start recording. If this fails, we keep tracking and try again on a later tick after backing off.
+        # Recordings have their own endpoint, so one that can't start (e.g. a full SD card) never holds back moves
+        started, result = self.supervisor.attempt("camera-recording",
+                                                  lambda: self.media.start_recording(self.disk_name,
+                                                                                     profile=self.profile_name),
+                                                  success=lambda rc: rc[1] != 1)
+        if started:
+            self.current_recording_name = result[0]  # Keep track of the recording name for management purposes
             self.activated = True  # Camera is now "active"
             log.info(f"Successfully started recording! id: {self.current_recording_name}")  # Inform the current rec ID
+        elif result is not None:
+            log.error(f'failed to start recording! error: {result[0]}')
 
+    def _move(self, track=True):
+        """
+        Move the camera to self.heading_xy, self.heading_z and self.zoom if the change is big enough.
+        Should not be called by user.
+        :param track: whether this is a tracking move. Only tracking moves from a tracked position are used to measure
+         latency, so large idle slews (pre-slewing, or acquiring the drone from the deactivated position) don't
+         inflate the lead
+        :return: none
+        """
+        log = self.log.getChild("move_camera")
         offset_heading_xy = (self.heading_xy + self.config["camera"]["offset"])
 
         if offset_heading_xy > 0:
@@ -241,41 +399,135 @@ class Camera:
         if offset_heading_xy < -180:  # Fix offset bug negative
             offset_heading_xy = 360 - offset_heading_xy
 
-        # Check if either of the pan, tilt, or zoom is greater than their respective minimum steps
-        if ((abs(self.current_pan - self.heading_xy))
-                > self.config['camera']['min_step'] or
-                (abs(self.current_tilt - self.heading_z)) > self.config['camera']['min_step'] or
-                (abs(self.current_zoom - self.zoom) > self.config['camera']['min_zoom_step'])):
+        if self._significant_move():
 
             log.info(f'moving to (p, t, z) {offset_heading_xy},'
-                     f' {self.heading_z}, {self.zoom}')  # Show the position we move to
+                     f' {self.heading_z}, {self.zoom} with {self.latency.report()}')  # Show the position we move to
 
             # Actually tell the camera to move
-            self.controller.absolute_move(offset_heading_xy,
-                                          self.heading_z, self.zoom)
-            # Update internal class data
-            self.current_pan = self.heading_xy
-            self.current_tilt = self.heading_z
-            self.current_zoom = self.zoom
+            command_start = time.perf_counter()
+            moved, _ = self.supervisor.attempt("camera-ptz",
+                                               lambda: self.controller.absolute_move(offset_heading_xy,
+                                                                                     self.heading_z, self.zoom),
+                                               success=lambda rc: True)
+            if moved:
+                if track and self.tracking:
+                    # The pooled controller sends moves in the background, so it measures the round trip itself
+                    round_trip = getattr(self.controller, 'round_trip', None)
+                    self.latency.observe_command(round_trip if round_trip is not None
+                                                 else time.perf_counter() - command_start)
+                    pan_change = (self.heading_xy - self.current_pan + 180) % 360 - 180  # The short way around
+                    self.latency.observe_slew(max(abs(pan_change), abs(self.current_tilt - self.heading_z)))
+                self.tracking = track
+                # Update internal class data
+                self.current_pan = self.heading_xy
+                self.current_tilt = self.heading_z
+                self.current_zoom = self.zoom
         else:  # We don't need to move the camera
             log.debug('Step is not significant enough to move the camera. ')
 
+    def _significant_move(self, pan=None, tilt=None, zoom=None):
+        """
+        Check if either of the pan, tilt, or zoom is greater than their respective minimum steps.
+        Should not be called by user.
+        :param pan: the pan to move from (None = self.current_pan)
+        :param tilt: the tilt to move from (None = self.current_tilt)
+        :param zoom: the zoom to move from (None = self.current_zoom)
+        :return: whether _move would send a command to the camera
+        """
+        pan = self.current_pan if pan is None else pan
+        tilt = self.current_tilt if tilt is None else tilt
+        zoom = self.current_zoom if zoom is None else zoom
+        return ((abs(pan - self.heading_xy)) > self.config['camera']['min_step'] or
+                (abs(tilt - self.heading_z)) > self.config['camera']['min_step'] or
+                (abs(zoom - self.zoom) > self.config['camera']['min_zoom_step']))
+
+    def _stop_recording(self, wait=True):
+        """
+        Stop the current recording, if there is one, and export it in the background. Should not be called by user.
+        :param wait: whether to keep trying until the recording is stopped (False = try once, if the supervisor allows)
+        :return: whether there is no recording anymore
+        """
+        log = self.log.getChild("stop_recording")
+        if self.current_recording_name == '':  # We aren't recording
+            return True
+        log.info('stopping the recording... (name=' + self.current_recording_name + ')')
+        recording_name = self.current_recording_name
+        if wait:  # Keep trying until the recording is stopped, backing off while the camera is unreachable
+            stopped, _ = self.supervisor.retry("camera-recording", lambda: self.media.stop_recording(recording_name))
+        else:
+            stopped, _ = self.supervisor.attempt("camera-recording", lambda: self.media.stop_recording(recording_name))
+        if not stopped:
+            log.error(f"failed to stop recording {recording_name}, will try again later")
+            return False
+        log.info('Success stopping recording!')
+        self.current_recording_name = ''  # We aren't recording anymore
+        # Downloading the recording takes a while, so don't hold up the tracking loop for it
+        threading.Thread(target=self._export_recording, args=(recording_name,), name=f"export-{recording_name}").start()
+        return True
+
+    def _export_recording(self, recording_name):
+        """
+        Export a stopped recording to camera/store_recordings. Run on its own thread by _stop_recording.
+        Should not be called by user.
+        :param recording_name: the name of the recording
+        :return: none
+        """
+        log = self.log.getChild("export_recording")
+        try:
+            export_status = self.media.export_recording(self.disk_name,
+                                                        recording_name,
+                                                        self.config["camera"]["store_recordings"] + "/"
+                                                        + recording_name + ".mkv")
+        except OSError as e:
+            log.error(f"Export of recording {recording_name} failed with {type(e).__name__}: {e}")
+            export_status = False
+        if not export_status:
+            log.error(f"Failed to export recording {recording_name}."
+                      f" The recording should still be on the SD card.")
+        else:
+            log.info(f"Exported recording {recording_name}")
+
     def deactivate(self, delay=0):
         """
-        Deactivate the drone after a set amount of time. The threading.Timer instantiated by this function is returned
+        Deactivate the drone after a set amount of time. The Deadline scheduled by this function is returned.
+        The deactivation runs on the first call to self.scheduler.run_pending() after the delay.
         :param delay: the amount of time until deactivation is triggered.
         """
         log = self.log.getChild("deactivate")
         log.info(f"now starting wait for {delay}s...")
 
-        if delay:  # Start a Timer
-            self.deactivating = True
-            worker = threading.Timer(delay, self._deactivate)
-            worker.start()
-            return worker
+        if delay and self.scheduler is None:
+            raise ValueError("Camera.deactivate with a delay needs the Camera to be given a scheduler")
+        if delay:  # Schedule the deactivation
+            return self._schedule_deactivation(delay)
         else:
+            self.cancel_deactivation()
             self._deactivate()  # Just deactivate the camera
 
+    def _schedule_deactivation(self, delay):
+        """
+        Schedule self._deactivate, or move it if it is already scheduled. Should not be called by user.
+        :param delay: the amount of time until deactivation is triggered.
+        :return: the Deadline
+        """
+        self.deactivating = True
+        if self.deactivation is None:
+            self.deactivation = self.scheduler.schedule(delay, self._deactivate, name="deactivate")
+        else:
+            self.scheduler.reschedule(self.deactivation, delay)
+        return self.deactivation
+
+    def cancel_deactivation(self):
+        """
+        Cancel a deferred deactivation, if there is one.
+        :return: none
+        """
+        if self.deactivating:
+            self.log.getChild("deactivate").info("deferred deactivation cancelled")
+            self.scheduler.cancel(self.deactivation)
+            self.deactivating = False
+
     def _deactivate(self):
         """
         Force deactivate the camera. Should not be called by user.
@@ -283,23 +535,16 @@ class Camera:
         """
         log = self.log.getChild("deactivate")
 
-        if self.current_recording_name != '':  # If we are recording, stop it
-            while True:
-                log.info('stopping the recording... (name=' + self.current_recording_name + ')')
-                stopped = self.media.stop_recording(self.current_recording_name)  # Did we stop the recording?
-                if stopped:  # We succeeded!
-                    log.info('Success stopping recording!')
-                    break
-                else:  # We failed :(
-                    log.info('failed to stop recording! retrying...')
-            export_status = self.media.export_recording(self.disk_name,
-                                                        self.current_recording_name,
-                                                        self.config["camera"]["store_recordings"] + "/"
-                                                        + self.current_recording_name + ".mkv")
-            if not export_status:
-                log.error(f"Failed to export recording {self.current_recording_name}."
-                          f" The recording should still be on the SD card.")
-            self.current_recording_name = ''  # We aren't recording anymore
+        # With a scheduler, this runs on the tracking loop, so only try once and come back later if the camera is
+        # unreachable instead of holding up the loop until it answers
+        if not self._stop_recording(wait=self.scheduler is None):
+            retry = max(self.supervisor.endpoint("camera-recording").wait_time(), self.supervisor.base_delay)
+            log.info(f"couldn't stop the recording, trying to deactivate again in {round(retry, 2)}s")
+            self._schedule_deactivation(retry)
+            return
+        log.info(self.visibility_report())
+        self.hidden_since = self.paused_since = None
+        self.hidden_time = self.paused_time = self.moves_suppressed = 0
 
         # Get the position we need to go to when we deactivate
         deactivate_pan = self.config['camera']['deactivate_pos']['pan']
@@ -322,11 +567,15 @@ class Camera:
         if not deactivate_tilt:
             deactivate_tilt = self.current_tilt
         log.info(f'deactivating to (p, t) {deactivate_pan}, {deactivate_tilt}')
-        self.controller.absolute_move(real_deactivate_pan,
-                                      deactivate_tilt)  # Deactivate the camera
-        # Update camera position
-        self.current_pan = deactivate_pan
-        self.current_tilt = deactivate_tilt
+        moved, _ = self.supervisor.attempt("camera-ptz",
+                                           lambda: self.controller.absolute_move(real_deactivate_pan,
+                                                                                 deactivate_tilt),
+                                           success=lambda rc: True)  # Deactivate the camera
+        if moved:
+            # Update camera position
+            self.current_pan = deactivate_pan
+            self.current_tilt = deactivate_tilt
+            self.tracking = False
 
         # We are done deactivating and are not active
         self.activated = False
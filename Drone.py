@@ -4,34 +4,49 @@ from kafka.errors import NoBrokersAvailable
 import kafka
 import json
 
+from History import TelemetryHistory
+from Scheduler import DeadlineScheduler
+
 
 class Drone:
     """
     A class to represent the drone and get its data via a Kafka topic.
     """
 
-    def __init__(self, connection="localhost:9092", topic="dronetracker-data", timeout=1):
+    def __init__(self, connection="localhost:9092", topic="dronetracker-data", timeout=1, auto_connect=True,
+                 history_length=3000, scheduler: DeadlineScheduler = None):
         """
         Initialize and connect to the drone.
         :param connection: where to connect to the Kafka server
         :param topic: topic to subscribe to for position/velocity information
-        :param timeout: The maximum age of packets from the Kafka server before we assume the experiment has concluded
+        :param timeout: The amount of seconds without packets from the Kafka server before we assume the experiment has
+         concluded
+        :param auto_connect: whether to connect to the Kafka server now (otherwise Drone.connect must be called)
+        :param history_length: the amount of fixes to keep in Drone.history
+        :param scheduler: the DeadlineScheduler to run the packet timeout on. If None, the Drone creates its own and
+         runs it in Drone.update; otherwise the owner of the scheduler must run it
         :return: None
         """
         self.start_time = time.time()
         self.lat = self.long = self.alt = self.vx = self.vy = self.vz = None
+        self.history = TelemetryHistory(history_length)  # Recent fixes, kept across experiments
         self.timeout = timeout
         self.consumer = None
         self.connection = connection
         self.topic = topic
-        self.connect()
+        if auto_connect:
+            self.connect()
         self.log = logging.getLogger('Drone')
         self.most_recent = 0
+        self.timestamp = None  # When the most recent packet was produced (seconds since the epoch)
+        self.owns_scheduler = scheduler is None
+        self.scheduler = DeadlineScheduler() if scheduler is None else scheduler
+        self.timeout_deadline = None  # Fires when no packet has been received for self.timeout seconds
 
     def connect(self):
         """
         Restart and connect to the Kafka server.
-        :return: None
+        :return: whether the connection succeeded
         """
         try:
             self.consumer = kafka.KafkaConsumer(bootstrap_servers=[self.connection])
@@ -39,25 +54,32 @@ class Drone:
             self.consumer = None
             return False
         self.consumer.subscribe([self.topic])
+        return True
 
     def update(self):
         """
         Get the position of the drone and save it to the class
-        :return: None
+        :return: whether a new fix was received
         """
         log = self.log.getChild("update")
+        if self.owns_scheduler:
+            self.scheduler.run_pending()
         msg = self.consumer.poll()
         if len(msg):  # is there new data?
             log.debug("Successfully received message from Kafka server")
             msg = msg[kafka.TopicPartition(self.topic, 0)][-1]  # We need to get the most recent message, thus the -1
         else:
             log.debug("No new data!")  # We don't need to do anything, just return.
-            if time.time() - self.most_recent > self.timeout:  # We can go into "deactivate" mode
-                self.most_recent = 0
             # The most recent data is already saved
-            return
+            return False
 
-        self.most_recent = msg.timestamp // 1000  # This is a new most recent
+        self.timestamp = msg.timestamp / 1000  # Keep the milliseconds to measure the telemetry age
+        self.most_recent = self.timestamp  # This is a new most recent
+        # Push the packet timeout back, timed from when we received the packet on the monotonic clock
+        if self.timeout_deadline is None:
+            self.timeout_deadline = self.scheduler.schedule(self.timeout, self._packet_timeout, name="packet-timeout")
+        else:
+            self.scheduler.reschedule(self.timeout_deadline, self.timeout)
         value = json.loads(msg.value)  # Load the JSON data in
         try:
             # Get data from dictionary and save it to class instance variables
@@ -70,10 +92,22 @@ class Drone:
         except KeyError:
             # We got a KeyError - the data isn't valid!
             self.log.error(f"Position data not present!\nData: {value}")
+            return False
+        self.history.append(self.timestamp, self.lat, self.long, self.alt, self.vx, self.vy, self.vz)
+        return True
+
+    def _packet_timeout(self):
+        """
+        Called by the scheduler when no packet has been received for self.timeout seconds. Should not be called by user.
+        :return: None
+        """
+        self.log.getChild("packet_timeout").info(f"No packets for {self.timeout}s")
+        self.most_recent = 0  # We can go into "deactivate" mode
 
     def reset(self):
         """
-        Reset the drone's data, so it isn't used in future experiments
+        Reset the drone's data, so it isn't used in future experiments. Drone.history is kept.
         :return: None
         """
         self.lat = self.long = self.alt = self.vx = self.vy = self.vz = None
+        self.timestamp = None
@@ -0,0 +1,115 @@
+import json
+import logging
+import math
+
+import numpy as np
+
+
+class FlightPlan:
+    """
+    A class to hold a pan/tilt/zoom schedule precomputed from a planned mission.
+    All of the camera geometry is done when the plan is received, so looking up a time is just an interpolation.
+    """
+
+    def __init__(self, times, pans, tilts, zooms, start: float = None):
+        """
+        Initialize the FlightPlan class. Use FlightPlan.from_waypoints to build one from a mission.
+        :param times: the time of each schedule entry (seconds after the start of the plan, increasing)
+        :param pans: the pan of each entry (degrees, without the camera offset)
+        :param tilts: the tilt of each entry (degrees)
+        :param zooms: the zoom of each entry (0-9999)
+        :param start: when the plan starts (seconds since the epoch, None = when it is anchored)
+        :return: None
+        """
+        self.times = np.asarray(times, dtype=float)
+        self.pans = np.unwrap(np.asarray(pans, dtype=float), period=360)  # So interpolating never spins the long way
+        self.tilts = np.asarray(tilts, dtype=float)
+        self.zooms = np.asarray(zooms, dtype=float)
+        self.start = start
+        self.log = logging.getLogger('FlightPlan')
+
+    @staticmethod
+    def parse(value: bytes):
+        """
+        Parse and check a flight_plan command.
+        Format: {"start": <seconds since the epoch, optional>,
+                 "waypoints": [{"time": <seconds after start>, "latitude": x, "longitude": x, "altitude": x}, ...]}
+        :param value: the value of the command
+        :return: the start time (or None) and the waypoints as a list of (time, lat, long, alt)
+        """
+        data = json.loads(value)
+        waypoints = [(float(waypoint["time"]), float(waypoint["latitude"]), float(waypoint["longitude"]),
+                      float(waypoint["altitude"])) for waypoint in data["waypoints"]]
+        if not waypoints:
+            raise ValueError("A flight plan needs at least one waypoint")
+        if not all(math.isfinite(value) for waypoint in waypoints for value in waypoint):
+            raise ValueError("Waypoint values must be finite numbers")
+        if any(second[0] < first[0] for first, second in zip(waypoints, waypoints[1:])):
+            raise ValueError("Waypoint times must not decrease")
+        start = data.get("start")
+        if start is not None:
+            start = float(start)
+            if not math.isfinite(start):
+                raise ValueError("The start time must be a finite number")
+        return start, waypoints
+
+    @classmethod
+    def from_waypoints(cls, camera, waypoints, start: float = None, step: float = 0.5):
+        """
+        Precompute the schedule of a mission with the camera's geometry.
+        :param camera: the Camera to calculate the pan, tilt and zoom with
+        :param waypoints: a list of (time, lat, long, alt), with time in seconds after the start of the plan
+        :param start: when the plan starts (seconds since the epoch, None = when it is anchored)
+        :param step: the amount of seconds between schedule entries
+        :return: the FlightPlan
+        """
+        waypoints = np.asarray(waypoints, dtype=float)
+        times = np.arange(waypoints[0, 0], waypoints[-1, 0], step)
+        times = np.append(times, waypoints[-1, 0])  # Always end on the last waypoint
+        pans, tilts, zooms = [], [], []
+        for t in times:
+            location = [np.interp(t, waypoints[:, 0], waypoints[:, column]) for column in (1, 2, 3)]
+            pan, tilt, dist_xy, dist_z = camera.calculate_heading_directions(location + [0, 0, 0], lead_time=0)
+            pans.append(pan)
+            tilts.append(tilt)
+            zooms.append(camera.calculate_zoom(dist_xy, dist_z)[1])
+        return cls(times, pans, tilts, zooms, start=start)
+
+    def anchor(self, start: float):
+        """
+        Set when the plan starts, if the mission didn't say.
+        :param start: when the plan starts (seconds since the epoch)
+        :return: none
+        """
+        if self.start is None:
+            self.start = start
+            self.log.info(f"Flight plan anchored at {start}")
+
+    def first(self):
+        """
+        :return: the pan, tilt and zoom of the takeoff point
+        """
+        return self._wrap(self.pans[0]), float(self.tilts[0]), float(self.zooms[0])
+
+    def at(self, now: float):
+        """
+        Look up where the camera should point at a time.
+        :param now: the time (seconds since the epoch)
+        :return: the pan, tilt and zoom, or None if the plan isn't anchored or doesn't cover the time
+        """
+        if self.start is None:
+            return None
+        t = now - self.start
+        if not self.times[0] <= t <= self.times[-1]:
+            return None
+        return (self._wrap(np.interp(t, self.times, self.pans)), float(np.interp(t, self.times, self.tilts)),
+                float(np.interp(t, self.times, self.zooms)))
+
+    @staticmethod
+    def _wrap(pan: float):
+        """
+        Wrap a pan back into -180 to 180 degrees. Should not be called by user.
+        :param pan: the pan (degrees)
+        :return: the wrapped pan
+        """
+        return float((pan + 180) % 360 - 180)
@@ -5,8 +5,13 @@ import time
 import logging
 import kafka
 from kafka import KafkaConsumer, KafkaProducer
+from kafka.errors import NoBrokersAvailable
+
+from FlightPlan import FlightPlan
+from Profiler import Profiler
 
 VALID_STATUS = [b"off", b"on", b"auto"]
+DOWNLOADABLE_EXTENSIONS = (".mkv", ".collapsed", ".tracemalloc")  # Recordings and profile artifacts
 
 
 class KafkaGateway:
@@ -16,26 +21,49 @@ class KafkaGateway:
 
     def __init__(self, connection: str, command_topic: str = "dronetracker_command",
                  output_topic: str = "dronetracker_output", recording_storage_location: str = "recordings",
-                 oeo_port: int = 15321):
+                 oeo_port: int = 15321, profile_max_duration: float = 300, auto_connect: bool = True):
         """
         Initialize the Gateway class
         :param connection: Kafka connection IP
         :param command_topic: Kafka topic to watch for
+        :param profile_max_duration: the maximum amount of seconds a start_profile command can profile for
+        :param auto_connect: whether to connect to the Kafka server now (otherwise KafkaGateway.connect must be called)
         :return: None
         """
         self.connection = connection  # Connection IP
-        self.consumer = KafkaConsumer(bootstrap_servers=[connection])
-        self.producer = KafkaProducer(bootstrap_servers=[connection])
+        self.consumer = None
+        self.producer = None
         self.command_topic = command_topic
         self.output_topic = output_topic
         self.recording_storage_location = recording_storage_location
-        self.consumer.subscribe([self.command_topic])
+        if auto_connect:
+            self.connect()
         self.log = logging.getLogger('Gateway')
         self.oeo_port = oeo_port
         self.export_threads = {}
+        self.profiler = Profiler(recording_storage_location, max_duration=profile_max_duration)
         self.status = "off"  # We default to "off" on startup.
+        self.flight_plan = None  # The (start, waypoints) of the newest flight_plan command, until it is picked up
         # Should the command  topic send confirmation that experiment is active?
 
+    def connect(self):
+        """
+        Connect to the Kafka server.
+        :return: whether the connection succeeded
+        """
+        consumer = None
+        try:
+            consumer = KafkaConsumer(bootstrap_servers=[self.connection])
+            producer = KafkaProducer(bootstrap_servers=[self.connection])
+        except NoBrokersAvailable:
+            if consumer is not None:  # The producer failed, so don't leak the consumer on every retry
+                consumer.close()
+            self.consumer = self.producer = None
+            return False
+        self.consumer, self.producer = consumer, producer
+        self.consumer.subscribe([self.command_topic])
+        return True
+
     def update(self):
         """
         Update the status from the Kafka server
@@ -51,7 +79,7 @@ class KafkaGateway:
             if not os.path.exists(self.recording_storage_location):
                 os.makedirs(self.recording_storage_location)
             recordings = sorted([file for file in os.listdir(self.recording_storage_location)
-                                 if file.endswith(".mkv")])
+                                 if file.endswith(DOWNLOADABLE_EXTENSIONS)])
 
             for message in messages:
                 if message.key == b"track_camera" and message.value in VALID_STATUS:
@@ -90,7 +118,8 @@ class KafkaGateway:
                         Nested function to run the netcat command in a thread
                         :param identification: the ID of the recording worker
                         """
-                        netcat = os.system(f"netcat -N {oeo_server_ip} {self.oeo_port} < {recordings[recording_num]}")
+                        path = os.path.join(self.recording_storage_location, recordings[recording_num])
+                        netcat = os.system(f"netcat -N {oeo_server_ip} {self.oeo_port} < {path}")
                         if netcat:
                             log.error("Failed to download recording, returning failure")
                             self.producer.send(self.output_topic, key=b"download_recording",
@@ -108,6 +137,41 @@ class KafkaGateway:
                     self.export_threads[len(self.export_threads) - 1].start()  # Start the worker
                     continue
 
+                elif message.key == b"flight_plan":  # Handle flight_plan feature
+                    try:
+                        self.flight_plan = FlightPlan.parse(message.value)
+                    except (ValueError, KeyError, TypeError) as e:
+                        log.error(f"Invalid flight plan: {e}")
+                        self.producer.send(self.output_topic, key=b"flight_plan", value=b"failure")
+                        continue
+                    # The reply is sent with KafkaGateway.reply once the schedule has been precomputed
+                    log.info(f"Received flight plan with {len(self.flight_plan[1])} waypoints")
+                    continue
+
+                elif message.key == b"start_profile":  # Handle start_profile feature
+                    # Format: start_profile [seconds]
+                    try:
+                        duration = float(message.value) if message.value else None
+                    except ValueError:
+                        log.error(f"Invalid arguments from verb start_profile (input was '{message.value}')")
+                        self.producer.send(self.output_topic, key=b"start_profile", value=b"failure")
+                        continue
+                    started = self.profiler.start(duration)
+                    self.producer.send(self.output_topic, key=b"start_profile",
+                                       value=b"success" if started else b"failure")
+                    continue
+
+                elif message.key == b"stop_profile":  # Handle stop_profile feature
+                    artifacts = self.profiler.stop()
+                    if artifacts is None:
+                        log.error("Received stop_profile, but no profile is running")
+                        self.producer.send(self.output_topic, key=b"stop_profile", value=b"failure")
+                    else:
+                        # The artifacts can be fetched with list_recordings and download_recording
+                        self.producer.send(self.output_topic, key=b"stop_profile",
+                                           value=("success " + ' '.join(artifacts)).encode("utf-8"))
+                    continue
+
                 log.error(f"Received invalid message from Kafka server! message={message.key} / {message.value}."
                           f" Ignoring message")  # Invalid key from the server
         else:
@@ -116,11 +180,21 @@ class KafkaGateway:
             return False
         return updated
 
-    def wait_for_status(self, status: str, hz: int = 10):
+    def reply(self, key: bytes, value: bytes):
+        """
+        Send a reply to a command on the output topic, for commands that finish outside of KafkaGateway.update.
+        :param key: the key of the command
+        :param value: the reply
+        :return: none
+        """
+        self.producer.send(self.output_topic, key=key, value=value)
+
+    def wait_for_status(self, status: str, hz: int = 10, on_cycle=None):
         """
         Wait for the server to send a certain status type.
         :param status: the desired status type
         :param hz: the number of times per second to poll (0 = as fast as possible)
+        :param on_cycle: a function to call after every poll (no arguments), or None
         :return: None
         """
         if hz == 0:
@@ -134,6 +208,8 @@ class KafkaGateway:
             # Use a timer for the action
             cycle_start = time.time()
             updated = self.update()  # Get new information from Kafka
+            if on_cycle is not None:
+                on_cycle()
             if updated and self.status == status:  # We are done!
                 break
             cycle_end = time.time()
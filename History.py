@@ -0,0 +1,118 @@
+import numpy as np
+
+FIELDS = ("time", "lat", "long", "alt", "vx", "vy", "vz")  # The columns of every row in the history
+TIME, LAT, LONG, ALT, VX, VY, VZ = range(len(FIELDS))
+
+
+class TelemetryHistory:
+    """
+    A class to store the most recent telemetry fixes of a vehicle in a fixed amount of memory.
+    Rows are (time, lat, long, alt, vx, vy, vz), oldest first, and must be appended in time order.
+    Every row is written twice (at i and i + capacity), so any run of recent rows is one contiguous slice
+    and can be returned as a NumPy view without copying.
+    Views are only valid until the next append: once the history is full, an append overwrites the slot the oldest
+    row of a held view points at, so the view is no longer in time order. Copy a view (view.copy()) to keep it.
+    """
+
+    __slots__ = ("capacity", "data", "end", "size")
+
+    def __init__(self, capacity: int = 3000):
+        """
+        Initialize the TelemetryHistory class
+        :param capacity: the maximum amount of fixes to keep
+        :return: None
+        """
+        self.capacity = capacity
+        self.data = np.zeros((2 * capacity, len(FIELDS)))
+        self.end = 0  # Where the next row will be written
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, timestamp: float, lat: float, long: float, alt: float, vx: float, vy: float, vz: float):
+        """
+        Add a fix, overwriting the oldest one if the history is full.
+        :param timestamp: when the fix was produced (seconds since the epoch)
+        :return: whether the fix was added (fixes older than the newest one are dropped to keep the history sorted)
+        """
+        if self.size and timestamp <= self.data[self.end + self.capacity - 1, TIME]:
+            return False
+        row = (timestamp, lat, long, alt, vx, vy, vz)
+        self.data[self.end] = row
+        self.data[self.end + self.capacity] = row
+        self.end = (self.end + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        return True
+
+    def clear(self):
+        """
+        Remove every fix.
+        :return: none
+        """
+        self.end = 0
+        self.size = 0
+
+    def view(self):
+        """
+        :return: a read-only view of every stored fix, oldest first. Not a copy, so it is only valid until the next
+         append (see TelemetryHistory)
+        """
+        start = self.end + self.capacity - self.size
+        view = self.data[start:start + self.size]
+        view.flags.writeable = False
+        return view
+
+    def latest(self):
+        """
+        :return: the newest fix, or None if the history is empty
+        """
+        if not self.size:
+            return None
+        return self.view()[-1]
+
+    def index(self, timestamp: float):
+        """
+        Find the position of a time in the history in O(log n).
+        :param timestamp: the time to look for (seconds since the epoch)
+        :return: the index into view() of the first fix at or after the time
+        """
+        return int(np.searchsorted(self.view()[:, TIME], timestamp, side="left"))
+
+    def between(self, start: float, end: float):
+        """
+        :param start: the start of the time range (seconds since the epoch, inclusive)
+        :param end: the end of the time range (seconds since the epoch, inclusive)
+        :return: a view of the fixes in the time range, only valid until the next append
+        """
+        view = self.view()
+        times = view[:, TIME]
+        return view[np.searchsorted(times, start, side="left"):np.searchsorted(times, end, side="right")]
+
+    def window(self, seconds: float, now: float = None):
+        """
+        :param seconds: how far back to go
+        :param now: the end of the window (None = the newest fix)
+        :return: a view of the fixes from the last few seconds, only valid until the next append
+        """
+        if not self.size:
+            return self.view()
+        if now is None:
+            now = self.view()[-1, TIME]
+        return self.between(now - seconds, now)
+
+    def at(self, timestamp: float):
+        """
+        Estimate the fix at a time by linearly interpolating between the fixes on either side of it.
+        :param timestamp: the time (seconds since the epoch)
+        :return: the interpolated row, or None if the time is outside of the history
+        """
+        view = self.view()
+        if not self.size or not view[0, TIME] <= timestamp <= view[-1, TIME]:
+            return None
+        after = self.index(timestamp)
+        if view[after, TIME] == timestamp:
+            return view[after].copy()
+        before = view[after - 1]
+        fraction = (timestamp - before[TIME]) / (view[after, TIME] - before[TIME])
+        return before + fraction * (view[after] - before)
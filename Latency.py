@@ -0,0 +1,90 @@
+import logging
+import time
+
+
+class LatencyEstimator:
+    """
+    A class to measure how far behind the drone the camera is, and turn that into the amount of seconds to lead it by.
+    The lag is the age of the telemetry, plus the round trip of the move command, plus the time the PTZ takes to settle.
+    """
+
+    def __init__(self, static_lead: float = 0, auto: bool = True, slew_rate: float = 90, max_lead: float = 3,
+                 smoothing: float = 0.2, clock=time.time):
+        """
+        Initialize the LatencyEstimator class
+        :param static_lead: the lead from the config (seconds). The floor of the lead, or the lead if auto is off
+        :param auto: whether the lead should be calculated from the measured delays
+        :param slew_rate: how fast the PTZ turns (degrees/second), used to estimate how long it takes to settle
+        :param max_lead: the most the measured delays can lead the drone by (seconds)
+        :param smoothing: how much each new measurement moves the averages (0-1, higher reacts faster)
+        :param clock: a function returning the current time in seconds since the epoch (matches Kafka timestamps)
+        :return: None
+        """
+        self.static_lead = static_lead
+        self.auto = auto
+        self.slew_rate = slew_rate
+        self.max_lead = max_lead
+        self.smoothing = smoothing
+        self.clock = clock
+        self.log = logging.getLogger('Latency')
+        self.telemetry_age = 0  # Age of the current fix when it reached us
+        self.round_trip = 0  # Average time a move command takes to be accepted by the camera
+        self.settle = 0  # Average time the PTZ takes to finish a move
+
+    def _average(self, average: float, value: float):
+        """
+        Update an exponentially weighted moving average. Should not be called by user.
+        :param average: the current average
+        :param value: the new measurement
+        :return: the new average
+        """
+        return average + self.smoothing * (value - average)
+
+    def observe_telemetry(self, timestamp: float):
+        """
+        Record the age of a newly received fix. Only call this once per fix, not on every tick.
+        The age isn't averaged, so the lead matches how old the fix the camera is pointing from actually is.
+        :param timestamp: when the fix was produced (seconds since the epoch)
+        :return: none
+        """
+        # Clock skew can make fixes look like they are from the future
+        self.telemetry_age = max(self.clock() - timestamp, 0)
+
+    def observe_command(self, duration: float):
+        """
+        Record the round trip of a move command.
+        :param duration: how long the command took (seconds)
+        :return: none
+        """
+        self.round_trip = self._average(self.round_trip, duration)
+
+    def observe_slew(self, degrees: float):
+        """
+        Record a move, estimating how long the PTZ takes to settle from how far it turned.
+        :param degrees: the largest of the pan and tilt change (degrees)
+        :return: none
+        """
+        self.settle = self._average(self.settle, abs(degrees) / self.slew_rate)
+
+    def measured(self):
+        """
+        :return: the sum of the measured delays (seconds)
+        """
+        return self.telemetry_age + self.round_trip + self.settle
+
+    def lead(self):
+        """
+        Calculate the lead to use for this tick.
+        :return: the lead (seconds)
+        """
+        if not self.auto:
+            return self.static_lead
+        return max(self.static_lead, min(self.measured(), self.max_lead))
+
+    def report(self):
+        """
+        :return: a string describing the chosen lead and where it came from
+        """
+        return (f"lead {round(self.lead(), 3)}s (telemetry_age {round(self.telemetry_age, 3)}s, "
+                f"round_trip {round(self.round_trip, 3)}s, settle {round(self.settle, 3)}s, "
+                f"floor {self.static_lead}s, auto {self.auto})")
@@ -0,0 +1,142 @@
+import logging
+import math
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+
+class Profiler:
+    """
+    A class to take on-demand CPU and memory profiles of the running program.
+    Nothing is sampled or traced while the profiler is stopped, so it has no overhead when it is off.
+    """
+
+    def __init__(self, output_location: str = "recordings", interval: float = 0.01, max_duration: float = 300,
+                 traceback_depth: int = 25):
+        """
+        Initialize the Profiler class
+        :param output_location: the directory to write the profile artifacts to
+        :param interval: the amount of seconds between each CPU sample
+        :param max_duration: the maximum amount of seconds a profile can run for before it is stopped automatically
+        :param traceback_depth: the number of frames tracemalloc should store for each allocation
+        :return: None
+        """
+        self.output_location = output_location
+        self.interval = interval
+        self.max_duration = max_duration
+        self.traceback_depth = traceback_depth
+        self.log = logging.getLogger('Profiler')
+        self.lock = threading.Lock()
+        self.samples = {}  # Collapsed stack -> number of times it was sampled
+        self.sampler = None
+        self.stop_event = threading.Event()
+        self.timer = None
+        self.started_tracemalloc = False
+        self.name = ''
+        self.artifacts = []  # The artifacts written by the most recent profile
+
+    @property
+    def running(self):
+        """
+        :return: whether a profile is currently being taken
+        """
+        return self.sampler is not None
+
+    def start(self, duration: float = None):
+        """
+        Start a CPU and memory profile. The profile is stopped automatically after the duration.
+        :param duration: the amount of seconds to profile for (None or above max_duration = max_duration)
+        :return: whether the profile was started
+        """
+        log = self.log.getChild("start")
+        with self.lock:
+            if self.running:
+                log.error("A profile is already running!")
+                return False
+            if duration is not None and not math.isfinite(duration):
+                log.error(f"Invalid profile duration {duration}")
+                return False
+            if duration is None or duration <= 0 or duration > self.max_duration:
+                duration = self.max_duration
+            self.name = self._unique_name(time.strftime("profile-%Y%m%d-%H%M%S"))
+            self.samples = {}
+            self.stop_event.clear()
+            if not tracemalloc.is_tracing():  # Don't steal tracemalloc from someone else
+                tracemalloc.start(self.traceback_depth)
+                self.started_tracemalloc = True
+            self.timer = threading.Timer(duration, self.stop)  # Keep the profile window bounded
+            self.timer.daemon = True
+            self.timer.start()
+            # Pass the timer's ident in, since stop() can clear self.timer while the sampler is still running
+            self.sampler = threading.Thread(target=self._sample, args=(self.timer.ident,), daemon=True)
+            self.sampler.start()
+        log.info(f"Started profile {self.name} for at most {duration}s")
+        return True
+
+    def stop(self):
+        """
+        Stop the current profile and write its artifacts.
+        :return: the file names of the written artifacts, or None if no profile was running
+        """
+        log = self.log.getChild("stop")
+        with self.lock:
+            if not self.running:
+                return None
+            self.stop_event.set()
+            if self.timer is not None and self.timer is not threading.current_thread():
+                self.timer.cancel()
+            self.timer = None
+            self.sampler.join()
+            self.sampler = None
+            snapshot = tracemalloc.take_snapshot()
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+                self.started_tracemalloc = False
+
+            if not os.path.exists(self.output_location):
+                os.makedirs(self.output_location)
+            cpu_name = self.name + ".collapsed"
+            memory_name = self.name + ".tracemalloc"
+            with open(os.path.join(self.output_location, cpu_name), "w") as cpu_file:
+                # Collapsed stack format, readable by flamegraph.pl and speedscope
+                for stack, count in sorted(self.samples.items(), key=lambda item: -item[1]):
+                    cpu_file.write(f"{stack} {count}\n")
+            snapshot.dump(os.path.join(self.output_location, memory_name))  # Load with tracemalloc.Snapshot.load
+            self.artifacts = [cpu_name, memory_name]
+        log.info(f"Stopped profile {self.name}, wrote {', '.join(self.artifacts)}")
+        return self.artifacts
+
+    def _unique_name(self, name: str):
+        """
+        Add a suffix to a profile name if artifacts with that name already exist. Should not be called by user.
+        :param name: the name to start from
+        :return: a name that won't overwrite an earlier profile's artifacts
+        """
+        unique_name = name
+        suffix = 1
+        while any(os.path.exists(os.path.join(self.output_location, unique_name + extension))
+                  for extension in (".collapsed", ".tracemalloc")):
+            unique_name = f"{name}-{suffix}"
+            suffix += 1
+        return unique_name
+
+    def _sample(self, timer_ident: int):
+        """
+        Sample the stacks of every thread until stop_event is set. Should not be called by user.
+        :param timer_ident: the ident of the timer thread, which isn't sampled
+        :return: none
+        """
+        ignored_threads = {threading.get_ident(), timer_ident}
+        while not self.stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in ignored_threads:  # Don't profile the profiler
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                collapsed = ';'.join(reversed(stack))
+                self.samples[collapsed] = self.samples.get(collapsed, 0) + 1
@@ -0,0 +1,159 @@
+import heapq
+import itertools
+import logging
+import time
+
+
+class Deadline:
+    """
+    A class to represent a task scheduled on a DeadlineScheduler. Keep it to cancel or reschedule the task.
+    """
+
+    __slots__ = ("callback", "period", "name", "when", "queued_at", "cancelled")
+
+    def __init__(self, callback, period: float = None, name: str = ""):
+        """
+        Initialize the Deadline class. Use DeadlineScheduler.schedule to create one.
+        :param callback: the function to call when the deadline passes (no arguments)
+        :param period: the amount of seconds between calls for a periodic task (None = call once)
+        :param name: the name of the task (used for logging)
+        :return: None
+        """
+        self.callback = callback
+        self.period = period
+        self.name = name
+        self.when = 0  # When the task should run
+        self.queued_at = None  # The time of the task's live heap entry (None = not in the heap)
+        self.cancelled = False
+
+
+class DeadlineScheduler:
+    """
+    A class to run timed tasks from the main loop without any threads.
+    Deadlines are kept in a heap by monotonic time. Call run_pending() regularly to run the ones that have passed.
+    Pushing a deadline back doesn't touch the heap; the entry is moved when it comes up, so a timeout that is
+    rescheduled on every packet costs O(1).
+    The clock can be replaced to drive the scheduler faster than real time in tests.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        """
+        Initialize the DeadlineScheduler class
+        :param clock: a function returning the current time in seconds (must never go backwards)
+        :return: None
+        """
+        self.clock = clock
+        self.heap = []  # (when, sequence, deadline)
+        self.sequence = itertools.count()  # Breaks ties so deadlines are never compared
+        self.log = logging.getLogger('Scheduler')
+
+    def schedule(self, delay: float, callback, period: float = None, name: str = ""):
+        """
+        Schedule a task.
+        :param delay: the amount of seconds until the task runs
+        :param callback: the function to call (no arguments)
+        :param period: the amount of seconds between runs after the first, for a periodic task (None = run once)
+        :param name: the name of the task (used for logging)
+        :return: the Deadline
+        """
+        deadline = Deadline(callback, period, name)
+        self._push(deadline, self.clock() + delay)
+        return deadline
+
+    def reschedule(self, deadline: Deadline, delay: float):
+        """
+        Move a task to a new time. This also re-arms a task that was cancelled or has already run.
+        :param deadline: the Deadline
+        :param delay: the amount of seconds from now until the task runs
+        :return: the Deadline
+        """
+        deadline.cancelled = False
+        self._push(deadline, self.clock() + delay)
+        return deadline
+
+    def cancel(self, deadline: Deadline):
+        """
+        Cancel a task. Nothing happens if it has already run.
+        :param deadline: the Deadline
+        :return: none
+        """
+        deadline.cancelled = True
+
+    def pending(self, deadline: Deadline):
+        """
+        :param deadline: the Deadline
+        :return: whether the task is still waiting to run
+        """
+        return not deadline.cancelled and deadline.queued_at is not None
+
+    def _push(self, deadline: Deadline, when: float):
+        """
+        Set when a deadline should run, adding a heap entry only if it has none that comes up early enough.
+        Should not be called by user.
+        :param deadline: the Deadline
+        :param when: the clock time the task should run at
+        :return: none
+        """
+        deadline.when = when
+        if deadline.queued_at is not None and deadline.queued_at <= when:
+            return  # The existing entry comes up first and will be moved to the new time then
+        deadline.queued_at = when  # Any older entry for this deadline is now stale
+        heapq.heappush(self.heap, (when, next(self.sequence), deadline))
+
+    def _pop_ready(self, now: float):
+        """
+        Pop the next deadline that should run by now, moving or dropping entries that aren't due anymore.
+        Should not be called by user.
+        :param now: the current clock time
+        :return: the Deadline, or None if nothing is due
+        """
+        while self.heap and self.heap[0][0] <= now:
+            when, _, deadline = heapq.heappop(self.heap)
+            if deadline.queued_at != when:
+                continue  # Stale entry, the deadline was moved earlier
+            deadline.queued_at = None
+            if deadline.cancelled:
+                continue
+            if deadline.when > now:  # It was pushed back, so move it to its new time
+                self._push(deadline, deadline.when)
+                continue
+            return deadline
+        return None
+
+    def next_deadline(self):
+        """
+        :return: the amount of seconds until the next task should run (0 if one is overdue), or None if there is none
+        """
+        while self.heap:
+            when, _, deadline = self.heap[0]
+            if deadline.queued_at == when and not deadline.cancelled and deadline.when == when:
+                return max(when - self.clock(), 0)
+            heapq.heappop(self.heap)  # Clean up the entry so the top of the heap is real
+            if deadline.queued_at == when:
+                deadline.queued_at = None
+                if not deadline.cancelled:
+                    self._push(deadline, deadline.when)
+        return None
+
+    def run_pending(self):
+        """
+        Run every task whose deadline has passed, in order.
+        :return: the amount of tasks that ran
+        """
+        log = self.log.getChild("run_pending")
+        now = self.clock()
+        ran = 0
+        while True:
+            deadline = self._pop_ready(now)
+            if deadline is None:
+                return ran
+            if deadline.period is not None:
+                # Periodic tasks keep their cadence instead of drifting by how late this run is,
+                # but skip the runs they missed instead of running them all at once
+                next_when = deadline.when + deadline.period
+                if next_when <= now:
+                    next_when = now + deadline.period
+                self._push(deadline, next_when)
+            log.debug(f"Running task {deadline.name} ({round(now - deadline.when, 3)}s late)")
+            deadline.callback()
+            ran += 1
@@ -0,0 +1,205 @@
+import logging
+import random
+import time
+
+CLOSED = "closed"  # The endpoint is healthy
+OPEN = "open"  # The endpoint is failing, so calls are not attempted
+HALF_OPEN = "half-open"  # The endpoint was failing, a trial call is allowed to see if it came back
+
+
+class Endpoint:
+    """
+    A class to track the health of a single endpoint with a circuit breaker and jittered exponential backoff.
+    """
+
+    def __init__(self, name: str, base_delay: float = 0.5, max_delay: float = 30, failure_threshold: int = 5,
+                 reset_timeout: float = 30, clock=time.monotonic, rng=random.random):
+        """
+        Initialize the Endpoint class
+        :param name: the name of the endpoint (used for logging)
+        :param base_delay: the amount of seconds to wait after the first failure
+        :param max_delay: the maximum amount of seconds to wait between attempts
+        :param failure_threshold: the amount of consecutive failures before the circuit opens
+        :param reset_timeout: the amount of seconds the circuit stays open before a trial call is allowed
+        :param clock: a function returning the current time in seconds
+        :param rng: a function returning a random float in [0, 1)
+        :return: None
+        """
+        self.name = name
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.rng = rng
+        self.log = logging.getLogger('Supervisor').getChild(name)
+        self.state = CLOSED
+        self.failures = 0  # Consecutive failures
+        self.opened_at = 0
+        self.next_attempt = 0  # The earliest time the next attempt is allowed
+
+    def delay(self):
+        """
+        Calculate the backoff delay after the current amount of consecutive failures.
+        Half of the delay is random ("equal jitter") so many clients don't retry in lockstep.
+        :return: the delay in seconds
+        """
+        if not self.failures:
+            return 0
+        delay = min(self.max_delay, self.base_delay * 2 ** (self.failures - 1))
+        return delay / 2 + self.rng() * delay / 2
+
+    def wait_time(self):
+        """
+        :return: the amount of seconds until an attempt is allowed (0 if it is allowed now)
+        """
+        now = self.clock()
+        wait = self.next_attempt - now
+        if self.state == OPEN:
+            wait = max(wait, self.opened_at + self.reset_timeout - now)
+        return max(wait, 0)
+
+    def available(self):
+        """
+        Check whether an attempt is allowed right now, moving an open circuit to half-open when its timeout expires.
+        :return: whether an attempt is allowed
+        """
+        if self.wait_time():
+            return False
+        if self.state == OPEN:
+            self.state = HALF_OPEN
+            self.log.info("Circuit half-open, trying the endpoint again")
+        return True
+
+    def record_success(self):
+        """
+        Record a successful call. The circuit closes and the backoff resets immediately.
+        :return: none
+        """
+        if self.state != CLOSED:
+            self.log.info(f"Endpoint recovered after {self.failures} failures, circuit closed")
+        self.state = CLOSED
+        self.failures = 0
+        self.next_attempt = 0
+
+    def record_failure(self):
+        """
+        Record a failed call, opening the circuit if there have been too many.
+        :return: none
+        """
+        self.failures += 1
+        now = self.clock()
+        self.next_attempt = now + self.delay()
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+            self.log.error(f"Circuit opened after {self.failures} consecutive failures")
+            self.state = OPEN
+            self.opened_at = now
+
+
+class ConnectionSupervisor:
+    """
+    A class to supervise the connections to the camera and the Kafka server, so retries back off instead of spinning.
+    """
+
+    def __init__(self, base_delay: float = 0.5, max_delay: float = 30, failure_threshold: int = 5,
+                 reset_timeout: float = 30, clock=time.monotonic, sleep=time.sleep, rng=random.random):
+        """
+        Initialize the ConnectionSupervisor class. The clock, sleep and rng can be replaced for testing.
+        :param base_delay: the amount of seconds to wait after the first failure
+        :param max_delay: the maximum amount of seconds to wait between attempts
+        :param failure_threshold: the amount of consecutive failures before an endpoint's circuit opens
+        :param reset_timeout: the amount of seconds a circuit stays open before a trial call is allowed
+        :param clock: a function returning the current time in seconds
+        :param sleep: a function to sleep for an amount of seconds
+        :param rng: a function returning a random float in [0, 1)
+        :return: None
+        """
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.sleep = sleep
+        self.rng = rng
+        self.endpoints = {}
+        self.log = logging.getLogger('Supervisor')
+
+    def endpoint(self, name: str):
+        """
+        Get the Endpoint with this name, creating it if needed.
+        :param name: the name of the endpoint
+        :return: the Endpoint
+        """
+        if name not in self.endpoints:
+            self.endpoints[name] = Endpoint(name, self.base_delay, self.max_delay, self.failure_threshold,
+                                            self.reset_timeout, clock=self.clock, rng=self.rng)
+        return self.endpoints[name]
+
+    def available(self, name: str):
+        """
+        :param name: the name of the endpoint
+        :return: whether an attempt to the endpoint is allowed right now
+        """
+        return self.endpoint(name).available()
+
+    def healthy(self, name: str):
+        """
+        :param name: the name of the endpoint
+        :return: whether the endpoint's circuit is closed
+        """
+        return self.endpoint(name).state == CLOSED
+
+    def health(self):
+        """
+        :return: a dictionary of endpoint name -> circuit state
+        """
+        return {name: endpoint.state for name, endpoint in self.endpoints.items()}
+
+    def attempt(self, name: str, function, success=bool, exceptions=(OSError,)):
+        """
+        Call the function once if the endpoint allows it. This never sleeps.
+        :param name: the name of the endpoint
+        :param function: the function to call (no arguments)
+        :param success: a function that takes the result and returns whether the call succeeded
+        :param exceptions: the exceptions that count as a failure instead of being raised
+        :return: whether the call succeeded, and the result of the call (None if it was not made or raised)
+        """
+        endpoint = self.endpoint(name)
+        if not endpoint.available():
+            return False, None
+        try:
+            result = function()
+        except exceptions as e:
+            self.log.getChild(name).error(f"Call failed with {type(e).__name__}: {e}")
+            endpoint.record_failure()
+            return False, None
+        if not success(result):
+            endpoint.record_failure()
+            return False, result
+        endpoint.record_success()
+        return True, result
+
+    def retry(self, name: str, function, success=bool, exceptions=(OSError,), max_attempts: int = None):
+        """
+        Call the function until it succeeds, sleeping with backoff between attempts.
+        :param name: the name of the endpoint
+        :param function: the function to call (no arguments)
+        :param success: a function that takes the result and returns whether the call succeeded
+        :param exceptions: the exceptions that count as a failure instead of being raised
+        :param max_attempts: the maximum amount of attempts (None = forever)
+        :return: whether the call succeeded, and the result of the last call
+        """
+        log = self.log.getChild(name)
+        endpoint = self.endpoint(name)
+        attempts = 0
+        result = None
+        while max_attempts is None or attempts < max_attempts:
+            wait = endpoint.wait_time()
+            if wait:
+                log.info(f"Waiting {round(wait, 2)}s before the next attempt (state={endpoint.state})")
+                self.sleep(wait)
+            attempts += 1
+            succeeded, result = self.attempt(name, function, success=success, exceptions=exceptions)
+            if succeeded:
+                return True, result
+        return False, result
@@ -0,0 +1,192 @@
+import logging
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPDigestAuth
+
+
+class VapixController:
+    """
+    A controller class that talks to the camera over pooled keep-alive HTTP sessions.
+    It can be used in place of both sensecam_control's CameraControl and CameraConfiguration.
+    PTZ commands are sent by a worker thread on their own session, so they never wait on recording management calls.
+    """
+
+    def __init__(self, ip: str, username: str, password: str, pool_size: int = 4, timeout: float = 10,
+                 scheme: str = "http", retry_delay: float = 1):
+        """
+        Initialize the VapixController class
+        :param ip: the ip (and optional port) of the camera
+        :param username: the username of the camera
+        :param password: the password of the camera
+        :param pool_size: the maximum amount of open connections to keep for each session
+        :param timeout: the amount of seconds to wait for the camera to respond
+        :param scheme: "http" or "https"
+        :param retry_delay: the amount of seconds to wait before resending a move that failed
+        :return: None
+        """
+        self.base_url = f"{scheme}://{ip}"
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.log = logging.getLogger('VapixController')
+        # One session for PTZ and one for recordings, so a long export can't hold up a move
+        self.ptz_session = self._session(username, password, pool_size)
+        self.media_session = self._session(username, password, pool_size)
+        self.condition = threading.Condition()
+        self.pending_move = None  # The newest move that hasn't been sent yet
+        self.error = None  # The exception raised by the last move, reported on the next call to absolute_move
+        self.round_trip = None  # How long the last move took to be accepted by the camera (seconds)
+        self.running = True
+        self.worker = threading.Thread(target=self._send_moves, daemon=True)
+        self.worker.start()
+
+    @staticmethod
+    def _session(username: str, password: str, pool_size: int):
+        """
+        Create a keep-alive session. The digest auth object is kept on the session, so its nonce is reused.
+        Should not be called by user.
+        :param username: the username of the camera
+        :param password: the password of the camera
+        :param pool_size: the maximum amount of open connections to keep
+        :return: the requests.Session
+        """
+        session = requests.Session()
+        session.auth = HTTPDigestAuth(username, password)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def absolute_move(self, pan: float = None, tilt: float = None, zoom: int = None, speed: int = None):
+        """
+        Queue a move to an absolute position. This doesn't wait for the camera.
+        If a move is already waiting to be sent, it is replaced, since only the newest position matters.
+        A move that fails is resent every retry_delay seconds until it succeeds or a newer move replaces it, so the
+        camera always ends up at the last position it was sent.
+        :param pan: the pan to move to (degrees)
+        :param tilt: the tilt to move to (degrees)
+        :param zoom: the zoom to move to (0-9999)
+        :param speed: the speed to move at
+        :return: none. Raises the error from the previous move if it failed
+        """
+        with self.condition:
+            error, self.error = self.error, None
+            self.pending_move = {'pan': pan, 'tilt': tilt, 'zoom': zoom, 'speed': speed}
+            self.condition.notify()
+        if error is not None:
+            raise error
+
+    def _send_moves(self):
+        """
+        Send queued moves to the camera until close() is called. Should not be called by user.
+        :return: none
+        """
+        log = self.log.getChild("send_moves")
+        while True:
+            with self.condition:
+                while self.pending_move is None and self.running:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                move, self.pending_move = self.pending_move, None
+            params = {key: value for key, value in move.items() if value is not None}
+            params.update({'camera': 1, 'html': 'no'})
+            start = time.perf_counter()
+            try:
+                response = self.ptz_session.get(self.base_url + "/axis-cgi/com/ptz.cgi", params=params,
+                                                timeout=self.timeout)
+                response.raise_for_status()
+            except requests.RequestException as e:
+                log.error(f"Failed to move camera: {e}")
+                with self.condition:
+                    self.error = e
+                    if self.pending_move is None:  # Nothing newer to send, so send this move again
+                        self.pending_move = move
+                        self.condition.wait(self.retry_delay)  # A newer move or close() ends the wait early
+                continue
+            with self.condition:
+                self.error = None  # The camera is reachable again, so an earlier failure is no longer relevant
+            self.round_trip = time.perf_counter() - start
+
+    def _media_request(self, path: str, params: dict):
+        """
+        Send a recording management request and parse the XML response. Should not be called by user.
+        :param path: the path of the VAPIX endpoint
+        :param params: the query parameters
+        :return: the root element of the response, or None if the request failed
+        """
+        log = self.log.getChild("media")
+        try:
+            response = self.media_session.get(self.base_url + path, params=params, timeout=self.timeout)
+            response.raise_for_status()
+            return ElementTree.fromstring(response.content)
+        except (requests.RequestException, ElementTree.ParseError) as e:
+            log.error(f"Request to {path} failed: {e}")
+            return None
+
+    def start_recording(self, disk_name: str, profile: str = None):
+        """
+        Start a recording on the camera.
+        :param disk_name: the disk to record to
+        :param profile: the stream profile to record with (None = camera default)
+        :return: the recording id and 0 if it started, or the error and 1 if it didn't
+        """
+        params = {'diskid': disk_name}
+        if profile is not None:
+            params['profile'] = profile
+        root = self._media_request("/axis-cgi/record/record.cgi", params)
+        if root is None:
+            return 'request failed', 1
+        record = root if root.tag == 'record' else root.find('record')
+        if record is None or record.get('result') != 'OK':
+            return ElementTree.tostring(root, encoding="unicode"), 1
+        return record.get('recordingid'), 0
+
+    def stop_recording(self, recording_id: str):
+        """
+        Stop a recording on the camera.
+        :param recording_id: the id of the recording to stop
+        :return: whether the recording was stopped
+        """
+        root = self._media_request("/axis-cgi/record/stop.cgi", {'recordingid': recording_id})
+        if root is None:
+            return False
+        stop = root if root.tag == 'stop' else root.find('stop')
+        return stop is not None and stop.get('result') == 'OK'
+
+    def export_recording(self, disk_name: str, recording_id: str, path: str):
+        """
+        Download a recording from the camera as a Matroska file.
+        :param disk_name: the disk the recording is on
+        :param recording_id: the id of the recording
+        :param path: the path to save the recording to
+        :return: whether the recording was exported
+        """
+        log = self.log.getChild("export")
+        params = {'schemaversion': 1, 'recordingid': recording_id, 'diskid': disk_name, 'exportformat': 'matroska'}
+        try:
+            with self.media_session.get(self.base_url + "/axis-cgi/record/export/exportrecording.cgi",
+                                        params=params, timeout=self.timeout, stream=True) as response:
+                response.raise_for_status()
+                with open(path, "wb") as recording_file:
+                    for chunk in response.iter_content(chunk_size=1 << 16):
+                        recording_file.write(chunk)
+        except (requests.RequestException, OSError) as e:
+            log.error(f"Failed to export recording {recording_id}: {e}")
+            return False
+        return True
+
+    def close(self):
+        """
+        Stop the PTZ worker and close the sessions.
+        :return: none
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.worker.join()
+        self.ptz_session.close()
+        self.media_session.close()
@@ -0,0 +1,49 @@
+class VisibilityMask:
+    """
+    A class to answer whether the camera can see a direction, from a grid of azimuth/elevation cells built once.
+    A cell is hidden if it is outside the PTZ's tilt range, or below an obstruction (buildings, trees, terrain).
+    """
+
+    __slots__ = ("resolution", "azimuth_cells", "elevation_cells", "grid")
+
+    def __init__(self, tilt_min: float = -90, tilt_max: float = 90, obstructions=(), resolution: float = 1):
+        """
+        Initialize the VisibilityMask class
+        :param tilt_min: the lowest the camera can tilt (degrees)
+        :param tilt_max: the highest the camera can tilt (degrees)
+        :param obstructions: a list of (from azimuth, to azimuth, elevation). Between the azimuths (degrees clockwise
+         from north, may wrap past 360), anything lower than the elevation (degrees) is hidden
+        :param resolution: the size of each cell (degrees)
+        :return: None
+        """
+        self.resolution = resolution
+        self.azimuth_cells = round(360 / resolution)
+        self.elevation_cells = round(180 / resolution) + 1
+        self.grid = bytearray(self.azimuth_cells * self.elevation_cells)  # 1 = visible, one byte per cell
+
+        # The horizon of each azimuth cell is the highest obstruction covering it
+        horizon = [-90.0] * self.azimuth_cells
+        for start, end, elevation in obstructions:
+            start_cell = int((start % 360) // resolution)
+            width = round(((end - start) % 360) / resolution) or self.azimuth_cells  # from == to covers everything
+            for offset in range(width):
+                cell = (start_cell + offset) % self.azimuth_cells
+                horizon[cell] = max(horizon[cell], elevation)
+
+        for azimuth_cell in range(self.azimuth_cells):
+            row = azimuth_cell * self.elevation_cells
+            for elevation_cell in range(self.elevation_cells):
+                elevation = elevation_cell * resolution - 90
+                if tilt_min <= elevation <= tilt_max and elevation >= horizon[azimuth_cell]:
+                    self.grid[row + elevation_cell] = 1
+
+    def visible(self, azimuth: float, elevation: float):
+        """
+        Check whether a direction can be seen in O(1).
+        :param azimuth: the direction (degrees clockwise from north)
+        :param elevation: the elevation (degrees above the horizon)
+        :return: whether the direction is visible
+        """
+        azimuth_cell = int((azimuth % 360) // self.resolution) % self.azimuth_cells
+        elevation_cell = min(max(round((elevation + 90) / self.resolution), 0), self.elevation_cells - 1)
+        return self.grid[azimuth_cell * self.elevation_cells + elevation_cell] == 1
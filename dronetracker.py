@@ -1,10 +1,14 @@
 from ruamel.yaml import YAML
+import threading
 import time
 from Drone import Drone
 from Camera import Camera
+from FlightPlan import FlightPlan
 import logging
 
 from Gateway import KafkaGateway
+from Scheduler import DeadlineScheduler
+from Supervisor import ConnectionSupervisor
 
 with open("config.yml") as config_file:
     configuration = YAML().load(config_file)
@@ -13,6 +17,8 @@ log_level = {"debug": 10, "info": 20, "warning": 30, "error": 40}[configuration[
 hertz_deactivated = configuration["kafka"]["hz"] == 0
 logging.basicConfig(level=log_level)
 logging.getLogger("kafka").setLevel(level=log_level)
+supervisor = ConnectionSupervisor(**configuration["supervisor"])
+scheduler = DeadlineScheduler()  # Runs packet timeouts, deferred deactivations and periodic reports
 
 
 def get_drone():
@@ -22,50 +28,145 @@ def get_drone():
     """
     log = logging.getLogger('get_drone')
     log.info('Waiting for drone...')
-    while True:
-        new_drone = Drone(connection=configuration["kafka"]["ip"], topic=configuration["kafka"]["data_topic"],
-                          timeout=configuration["camera"]["stop_recording_after"])
-        if new_drone.consumer is None:  # Drone consumer failed connection, so we will try again
-            log.info("Failed to connect to Kafka server! Trying again in 1 second...")
-            time.sleep(1)
-            continue
-        break
+    new_drone = Drone(connection=configuration["kafka"]["ip"], topic=configuration["kafka"]["data_topic"],
+                      timeout=configuration["camera"]["stop_recording_after"], auto_connect=False,
+                      history_length=configuration["kafka"]["history_length"], scheduler=scheduler)
+    supervisor.retry("kafka", new_drone.connect)  # Reconnect the same Drone, backing off while Kafka is down
     return new_drone
 
 
+def build_flight_plan(start, waypoints, received):
+    """
+    Precompute the schedule of a flight plan. Run on its own thread, since a long plan takes over a second.
+    :param start: when the plan starts (seconds since the epoch, or None)
+    :param waypoints: the waypoints from FlightPlan.parse
+    :param received: when the plan was received (seconds since the epoch)
+    :return: none
+    """
+    global built_flight_plan
+    try:
+        plan = FlightPlan.from_waypoints(camera, waypoints, start=start, step=configuration["flight_plan"]["step"])
+    except (ValueError, ArithmeticError) as e:  # e.g. a waypoint exactly at the camera, or out of geopy's range
+        logging.error(f"Failed to precompute the flight plan: {type(e).__name__}: {e}")
+        plan = None
+    built_flight_plan = (plan, received)
+
+
+def load_flight_plan():
+    """
+    Start precomputing a flight plan received by the gateway, and use it once it is ready.
+    The camera pre-slews to its takeoff point if we are idle. A plan without a start time that arrives during an
+    experiment starts when it was received.
+    :return: none
+    """
+    global flight_plan, built_flight_plan, flight_plan_builder
+    if built_flight_plan is not None:
+        plan, received = built_flight_plan
+        built_flight_plan = flight_plan_builder = None
+        if plan is None:
+            gateway.reply(b"flight_plan", b"failure")
+        else:
+            flight_plan = plan
+            logging.info(f"Precomputed flight plan schedule of {len(flight_plan.times)} points")
+            gateway.reply(b"flight_plan", b"success")
+            if active:
+                flight_plan.anchor(received)
+            else:
+                camera.pre_slew(flight_plan)
+    if gateway.flight_plan is not None and flight_plan_builder is None:
+        start, waypoints = gateway.flight_plan
+        gateway.flight_plan = None
+        flight_plan_builder = threading.Thread(target=build_flight_plan, args=(start, waypoints, time.time()),
+                                               daemon=True)
+        flight_plan_builder.start()
+
+
+def idle_cycle():
+    """
+    Called on every poll while waiting for an experiment, so flight plans are loaded and deadlines still run
+    :return: none
+    """
+    load_flight_plan()
+    scheduler.run_pending()
+
+
+def report():
+    """
+    Log the health of the connections and how the camera is doing. Run periodically by the scheduler
+    :return: none
+    """
+    log = logging.getLogger('report')
+    log.info(f"connections: {supervisor.health()}")
+    log.info(f"latency compensation: {camera.latency.report()}")
+    log.info(f"visibility: {camera.visibility_report()}")
+
+
 active = False
+flight_plan = None
+flight_plan_builder = None  # The thread precomputing the newest flight plan
+built_flight_plan = None  # The (FlightPlan or None if it failed, time received) from flight_plan_builder
 if __name__ == '__main__':
     gateway = KafkaGateway(configuration["kafka"]["ip"],
                            configuration["kafka"]["command_topic"],
                            configuration["kafka"]["output_topic"],
-                           configuration["camera"]["store_recordings"])
+                           configuration["camera"]["store_recordings"],
+                           auto_connect=False)
+    supervisor.retry("kafka", gateway.connect)
     drone = get_drone()
-    camera = Camera(configuration, actually_move=configuration["camera"]["move"])  # Create camera
+    camera = Camera(configuration, actually_move=configuration["camera"]["move"], supervisor=supervisor,
+                    scheduler=scheduler)
+    if configuration["report_interval"]:
+        scheduler.schedule(configuration["report_interval"], report, period=configuration["report_interval"],
+                           name="report")
     while True:
         logging.info("Now waiting for experiment...")
-        gateway.wait_for_status("on", hz=configuration["kafka"]["hz"])
+        gateway.wait_for_status("on", hz=configuration["kafka"]["hz"], on_cycle=idle_cycle)
         logging.info("Experiment is ready!")
+        active = True
+        if flight_plan is not None:
+            flight_plan.anchor(time.time())  # Plans without a start time start when tracking is turned on
         last_tick_active = False
+        timed_out = False  # Whether a deferred deactivation is waiting for telemetry to come back
         while True:
             start = time.time()
             gateway.update()  # Update experiment status
+            load_flight_plan()
+            scheduler.run_pending()  # Packet timeouts, deferred deactivations and periodic reports
+            if timed_out and not camera.deactivating:  # Telemetry didn't come back, so the camera has deactivated
+                break  # Exit loop
             if gateway.status == "off" and last_tick_active:  # Experiment is over
                 logging.error("We have been forcefully disabled by command action!")
                 camera.deactivate()  # Deactivate the camera
                 break  # Exit loop
-            if last_tick_active and not drone.most_recent:  # Drone hasn't received anything
-                logging.error("Packet timeout has occurred, deactivating")
-                camera.deactivate()  # Deactivate the camera
-                break  # Exit loop
-            drone.update()  # Update drone position/velocity data
+            now = time.time()
+            # Check the same time follow_plan will look up, so the plan never holds the timeout off without being used
+            planned = flight_plan is not None and flight_plan.at(now + camera.lead) is not None
+            if last_tick_active and not drone.most_recent and not planned and not timed_out:  # No packets
+                logging.error(f"Packet timeout has occurred, deactivating in {configuration['camera']['delay']}s")
+                camera.deactivate(configuration["camera"]["delay"])  # Deactivate the camera once the delay is over
+                timed_out = True  # Keep polling the drone, so telemetry that comes back in time cancels it
+            new_fix = drone.update()  # Update drone position/velocity data
+            telemetry_late = (drone.timestamp is None
+                              or now - drone.timestamp > configuration["flight_plan"]["late_after"])
 
-            if drone.most_recent:  # If we are active
+            if (drone.most_recent or planned) and not supervisor.available("camera-ptz"):
+                # The PTZ is down, so don't spend the tick on it until the supervisor allows another attempt
+                logging.debug(f"Camera is unavailable, skipping tick (health={supervisor.health()})")
+            elif planned and telemetry_late and camera.follow_plan(flight_plan, now):
+                # Telemetry is late or missing, so the flight plan is our best guess of where the drone is
+                last_tick_active = True
+                timed_out = False  # follow_plan cancelled any deferred deactivation
+            elif drone.most_recent:  # If we are active
                 last_tick_active = True
-                camera.move_camera([drone.lat, drone.long, drone.alt, drone.vx, drone.vy, drone.vz])
+                timed_out = False  # move_camera cancels any deferred deactivation
+                camera.move_camera([drone.lat, drone.long, drone.alt, drone.vx, drone.vy, drone.vz],
+                                   timestamp=drone.timestamp if new_fix else None)  # Only measure new fixes
             end = time.time()
             if not hertz_deactivated:
                 delta = 1 / configuration["kafka"]["hz"] - (end - start)
                 if delta > 0:
                     logging.debug(f"Now sleeping for {delta} seconds because of hertz: {configuration['kafka']['hz']}")
                     time.sleep(delta)
+        active = False
         drone.reset()
+        flight_plan = None  # A flight plan is only used for one experiment
@@ -0,0 +1,303 @@
+"""
+A program to benchmark the hot paths of the tracker offline, using NullController and fake Kafka objects.
+Reports ns/op and allocations/op, and fails when a benchmark regresses past the stored baseline
+(utils/benchmark_baseline.json) or has no baseline. Run with --save to record a new baseline.
+Timings are compared relative to a fixed calibration loop timed alongside every round, so a baseline recorded on one
+machine can gate runs on another.
+
+Usage: python utils/benchmark.py [--save] [--threshold 1.25] [--only name]
+"""
+import argparse
+import collections
+import json
+import logging
+import math
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import kafka
+from ruamel.yaml import YAML
+
+from Camera import Camera
+from Drone import Drone
+from Gateway import KafkaGateway
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "config.yml")
+
+FakeMessage = collections.namedtuple("FakeMessage", ["key", "value", "timestamp"])
+
+# Fixed synthetic drone positions (lat, long, alt, vx, vy, vz) around the camera in config.yml
+POSITIONS = [[35.727481 + 0.001, -78.695925, 120, 5, 0, 0],
+             [35.727481, -78.695925 + 0.001, 130, 0, 5, 1],
+             [35.727481 - 0.0005, -78.695925 - 0.0005, 95, -3, -3, 0],
+             [35.727481 + 0.002, -78.695925 + 0.002, 200, 10, 10, -2]]
+
+
+class FakeConsumer:
+    """
+    A stand-in for KafkaConsumer that returns the same batch of messages on every poll.
+    """
+
+    def __init__(self, topic, messages):
+        self.batch = {kafka.TopicPartition(topic, 0): messages}
+
+    def poll(self):
+        return self.batch
+
+
+class FakeTelemetryConsumer(FakeConsumer):
+    """
+    A stand-in for KafkaConsumer that returns one telemetry message per poll, each 100 ms newer than the last,
+    so every fix is new and goes through Drone.history.append.
+    """
+
+    def __init__(self, topic, value):
+        super().__init__(topic, [FakeMessage(None, value, 0)])
+        self.messages = self.batch[kafka.TopicPartition(topic, 0)]
+        self.value = value
+        self.timestamp = int(time.time() * 1000)
+
+    def poll(self):
+        self.timestamp += 100
+        self.messages[0] = FakeMessage(None, self.value, self.timestamp)
+        return self.batch
+
+
+class FakeProducer:
+    """
+    A stand-in for KafkaProducer that drops everything it is sent.
+    """
+
+    def send(self, *args, **kwargs):
+        return
+
+    def flush(self):
+        return
+
+
+def load_config():
+    """
+    Load config.yml with the camera forced into NullController mode.
+    :return: the configuration dictionary
+    """
+    with open(CONFIG_PATH) as config_file:
+        config = YAML().load(config_file)
+    config["camera"]["move"] = False
+    return config
+
+
+def bench_calculate_heading_directions(config):
+    camera = Camera(config, actually_move=False)
+    camera.drone_loc = POSITIONS[0]
+    return camera.calculate_heading_directions
+
+
+def bench_calculate_zoom(config):
+    camera = Camera(config, actually_move=False)
+    camera.dist_xy, camera.dist_z = 150.0, 40.0
+    return camera.calculate_zoom
+
+
+def bench_move_camera(config):
+    camera = Camera(config, actually_move=False)
+    camera.move_camera(POSITIONS[0])  # Start the (fake) recording so only the decision path is measured
+    positions = POSITIONS * 2
+    state = {"i": 0}
+
+    def run():
+        state["i"] = (state["i"] + 1) % len(positions)
+        camera.move_camera(positions[state["i"]])
+    return run
+
+
+def bench_drone_update(config):
+    drone = Drone(topic=config["kafka"]["data_topic"], auto_connect=False)
+    value = json.dumps({"position": {"latitude": POSITIONS[0][0], "longitude": POSITIONS[0][1],
+                                     "altitude": POSITIONS[0][2]},
+                        "velocity": {"x": 1, "y": 2, "z": 3}}).encode("utf-8")
+    drone.consumer = FakeTelemetryConsumer(drone.topic, value)
+    return drone.update
+
+
+def bench_gateway_update(config):
+    gateway = KafkaGateway(config["kafka"]["ip"], config["kafka"]["command_topic"], config["kafka"]["output_topic"],
+                           tempfile.mkdtemp(prefix="benchmark-recordings-"), auto_connect=False)
+    gateway.consumer = FakeConsumer(gateway.command_topic, [FakeMessage(b"track_camera", b"on", 0),
+                                                            FakeMessage(b"track_camera", b"bogus", 0),
+                                                            FakeMessage(b"list_recordings", b"", 0),
+                                                            FakeMessage(b"unknown_verb", b"", 0)])
+    gateway.producer = FakeProducer()
+    return gateway.update
+
+
+BENCHMARKS = {
+    "calculate_heading_directions": bench_calculate_heading_directions,
+    "calculate_zoom": bench_calculate_zoom,
+    "move_camera": bench_move_camera,
+    "drone_update": bench_drone_update,
+    "gateway_update": bench_gateway_update,
+}
+
+
+def calibrate(iterations: int = 20000, rounds: int = 5):
+    """
+    Time a fixed pure-Python loop, to scale the timings by how fast this machine and interpreter are.
+    :param iterations: the amount of loop iterations per timed round
+    :param rounds: the amount of timed rounds
+    :return: the fastest time per iteration (ns)
+    """
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter_ns()
+        total = 0.0
+        values = {}
+        for i in range(iterations):  # Float math, dictionary and string work, like the hot paths
+            total += math.sqrt(i) * math.sin(i)
+            values[i % 64] = str(i)
+        elapsed = time.perf_counter_ns() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / iterations
+
+
+def count_allocations(function, iterations: int):
+    """
+    Count the memory blocks a function allocates per call.
+    The allocated block count is sampled at every Python and C call and return, and every increase is counted, so
+    temporaries that are freed before the call returns count too. Objects reused from the interpreter's free lists
+    and allocations freed inside a single C call aren't seen, so this is a lower bound that is stable between runs.
+    :param function: the function to count (no arguments)
+    :param iterations: the amount of calls to average over
+    :return: the average amount of allocations per call
+    """
+    blocks = sys.getallocatedblocks
+    state = [0, 0]  # Allocations counted so far, block count at the last event
+
+    def profile(frame, event, arg):
+        current = blocks()
+        if current > state[1]:
+            state[0] += current - state[1]
+        state[1] = blocks()
+
+    def run(target):
+        state[0], state[1] = 0, blocks()
+        sys.setprofile(profile)
+        for _ in range(iterations):
+            target()
+        sys.setprofile(None)
+        return state[0]
+
+    overhead = run(lambda: None)  # What the profile hook and the loop count on their own
+    return max(run(function) - overhead, 0) / iterations
+
+
+def measure(function, iterations: int, rounds: int):
+    """
+    Measure a function.
+    ns/op is the fastest round, so noise from the rest of the machine only makes results slower, never faster.
+    relative is ns/op divided by the fastest calibration loop, which is timed before every round so both see the same
+    load on the machine. It is what is compared against the baseline.
+    allocs/op is the memory blocks one call allocates (see count_allocations), and peak_bytes/op is the most memory one
+    call holds at once.
+    :param function: the function to measure (no arguments)
+    :param iterations: the amount of calls per timed round
+    :param rounds: the amount of timed rounds
+    :return: a dictionary of the results
+    """
+    for _ in range(iterations // 10 + 1):  # Warm up
+        function()
+    best = None
+    calibration = None
+    for _ in range(rounds):
+        round_calibration = calibrate(rounds=1)
+        calibration = round_calibration if calibration is None else min(calibration, round_calibration)
+        start = time.perf_counter_ns()
+        for _ in range(iterations):
+            function()
+        elapsed = time.perf_counter_ns() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    allocations = count_allocations(function, min(iterations, 200))
+
+    tracemalloc.start()
+    peak = 0
+    for _ in range(iterations):
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        function()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+    tracemalloc.stop()
+    return {"ns_per_op": round(best / iterations, 1),
+            "relative": round(best / iterations / calibration, 3),
+            "allocs_per_op": round(allocations, 1),
+            "peak_bytes_per_op": peak}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--save", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="fail if a result is more than this many times its baseline (default 1.25)")
+    parser.add_argument("--iterations", type=int, default=2000, help="calls per timed round")
+    parser.add_argument("--rounds", type=int, default=5, help="timed rounds per benchmark")
+    parser.add_argument("--only", action="append", choices=list(BENCHMARKS), help="only run these benchmarks")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)  # Don't measure log output
+    config = load_config()
+    baseline = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = {}
+    regressions = []
+    missing = []  # Benchmarks without a baseline to compare against
+    print(f"{'benchmark':<30} {'ns/op':>12} {'relative':>10} {'allocs/op':>10} {'peak B/op':>10} {'vs baseline':>12}")
+    for name in args.only or BENCHMARKS:
+        result = measure(BENCHMARKS[name](config), args.iterations, args.rounds)
+        results[name] = result
+        comparison = "no baseline"
+        if name not in baseline:
+            missing.append(name)
+        else:
+            expected = baseline[name]
+            ratio = result["relative"] / expected["relative"]
+            comparison = f"{ratio:.2f}x"
+            if ratio > args.threshold:
+                regressions.append(f"{name}: {result['relative']} calibration loops/op is {ratio:.2f}x the baseline"
+                                   f" of {expected['relative']}")
+            # Allow a little slack so tiny counts don't fail on interpreter noise
+            if result["allocs_per_op"] > expected["allocs_per_op"] * args.threshold + 1:
+                regressions.append(f"{name}: {result['allocs_per_op']} allocs/op is over the baseline"
+                                   f" of {expected['allocs_per_op']} allocs/op")
+            if result["peak_bytes_per_op"] > expected["peak_bytes_per_op"] * args.threshold + 64:
+                regressions.append(f"{name}: {result['peak_bytes_per_op']} peak B/op is over the baseline"
+                                   f" of {expected['peak_bytes_per_op']} peak B/op")
+        print(f"{name:<30} {result['ns_per_op']:>12} {result['relative']:>10} {result['allocs_per_op']:>10}"
+              f" {result['peak_bytes_per_op']:>10} {comparison:>12}")
+
+    if args.save:
+        baseline.update(results)
+        with open(BASELINE_PATH, "w") as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+        print(f"Saved baseline to {BASELINE_PATH}")
+        return 0
+    if missing:
+        print(f"\nNo baseline for {', '.join(missing)} in {BASELINE_PATH}. Run with --save to record one.")
+    if regressions:
+        print("\nRegressions over the threshold of " + str(args.threshold) + "x:")
+        for regression in regressions:
+            print("  " + regression)
+        return 1
+    return 1 if missing else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
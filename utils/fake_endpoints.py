@@ -0,0 +1,241 @@
+"""
+A program to exercise the ConnectionSupervisor against local fake Kafka and camera endpoints that go down and come back.
+Runs on a fake clock, so minutes of outage take well under a second. Exits with 1 if the supervisor misbehaves:
+retrying too often while an endpoint is down, reconnecting too slowly once it is back, or leaking Kafka consumers.
+
+Usage: python utils/fake_endpoints.py [--outage 60]
+"""
+import argparse
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import kafka
+from kafka.errors import NoBrokersAvailable
+from ruamel.yaml import YAML
+
+import Gateway
+from Camera import Camera, NullController
+from Drone import Drone
+from Supervisor import ConnectionSupervisor
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "config.yml")
+
+# Two drone positions (lat, long, alt, vx, vy, vz) far enough apart that every tick is a real move
+POSITIONS = [[35.727481 + 0.001, -78.695925, 120, 0, 0, 0],
+             [35.727481, -78.695925 + 0.001, 120, 0, 0, 0]]
+
+
+class FakeClock:
+    """
+    A clock that only moves when it is told to, or when something sleeps on it.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+
+class FakeEndpoint:
+    """
+    An endpoint that is down between two times on the fake clock, and counts the calls made to it.
+    """
+
+    def __init__(self, clock: FakeClock, down_at: float, up_at: float):
+        self.clock = clock
+        self.down_at = down_at
+        self.up_at = up_at
+        self.calls = 0
+        self.calls_while_down = 0
+
+    def up(self):
+        """
+        :return: whether the endpoint is up, counting the call
+        """
+        self.calls += 1
+        if self.down_at <= self.clock() < self.up_at:
+            self.calls_while_down += 1
+            return False
+        return True
+
+
+class FakeBroker(FakeEndpoint):
+    """
+    A fake Kafka broker. Its consumers and producers raise NoBrokersAvailable while it is down, like the real ones.
+    The producer can be set to keep failing after the broker is back, to check that half-built connections are closed.
+    """
+
+    def __init__(self, clock: FakeClock, down_at: float, up_at: float, producer_up_at: float = None):
+        super().__init__(clock, down_at, up_at)
+        self.producer_up_at = up_at if producer_up_at is None else producer_up_at
+        self.open_consumers = 0
+
+    def consumer(self, *args, **kwargs):
+        if not self.up():
+            raise NoBrokersAvailable()
+        self.open_consumers += 1
+        return FakeConsumer(self)
+
+    def producer(self, *args, **kwargs):
+        if self.clock() < self.producer_up_at:
+            raise NoBrokersAvailable()
+        return FakeProducer()
+
+
+class FakeConsumer:
+    """
+    A stand-in for KafkaConsumer that never has any messages.
+    """
+
+    def __init__(self, broker: FakeBroker):
+        self.broker = broker
+        self.closed = False
+
+    def subscribe(self, topics):
+        return
+
+    def poll(self):
+        return {}
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.broker.open_consumers -= 1
+
+
+class FakeProducer:
+    """
+    A stand-in for KafkaProducer that drops everything it is sent.
+    """
+
+    def send(self, *args, **kwargs):
+        return
+
+    def flush(self):
+        return
+
+
+class FakePTZ(NullController):
+    """
+    A NullController whose moves raise OSError while the fake camera endpoint is down.
+    """
+
+    def __init__(self, endpoint: FakeEndpoint):
+        super().__init__()
+        self.endpoint = endpoint
+        self.moves = 0
+
+    def absolute_move(self, *args):
+        if not self.endpoint.up():
+            raise OSError("fake camera is unreachable")
+        self.moves += 1
+
+
+def new_supervisor(config, clock: FakeClock):
+    """
+    :return: a ConnectionSupervisor from the config, running on the fake clock with the average jitter
+    """
+    return ConnectionSupervisor(**config["supervisor"], clock=clock, sleep=clock.sleep, rng=lambda: 0.5)
+
+
+def reconnect_limit(config):
+    """
+    :return: the most seconds an endpoint that came back may wait for its next attempt
+    """
+    return max(config["supervisor"]["max_delay"], config["supervisor"]["reset_timeout"])
+
+
+def check_kafka(config, outage: float):
+    """
+    Reconnect a Drone and a KafkaGateway while the broker is down, the way dronetracker.py does at startup.
+    :return: a list of problems (empty if everything behaved)
+    """
+    problems = []
+    clock = FakeClock()
+    supervisor = new_supervisor(config, clock)
+    # The gateway's producer comes back 30s after the broker, so its consumer has to be closed on each retry
+    broker = FakeBroker(clock, 0, outage, producer_up_at=outage + 30)
+    kafka.KafkaConsumer = Gateway.KafkaConsumer = broker.consumer
+    Gateway.KafkaProducer = broker.producer
+
+    drone = Drone(topic=config["kafka"]["data_topic"], auto_connect=False)
+    supervisor.retry("kafka", drone.connect)
+    drone_lag = clock() - outage
+    gateway = Gateway.KafkaGateway("fake", config["kafka"]["command_topic"], config["kafka"]["output_topic"],
+                                   config["camera"]["store_recordings"], auto_connect=False)
+    supervisor.retry("kafka", gateway.connect)
+    gateway_lag = clock() - broker.producer_up_at
+
+    print(f"kafka: down for {outage}s, {broker.calls_while_down} attempts while down, drone reconnected"
+          f" {round(drone_lag, 2)}s after the broker came back, gateway {round(gateway_lag, 2)}s after its producer,"
+          f" {broker.open_consumers} open consumers (health={supervisor.health()})")
+    # Backing off doubles the delay each time, so the attempts grow with the log of the outage, not its length
+    if broker.calls_while_down > config["supervisor"]["failure_threshold"] + outage / reconnect_limit(config) + 1:
+        problems.append(f"kafka: {broker.calls_while_down} attempts while down is too many")
+    if drone_lag > reconnect_limit(config) or gateway_lag > reconnect_limit(config):
+        problems.append("kafka: took too long to reconnect once the broker was back")
+    if broker.open_consumers != 2:  # The drone's and the gateway's
+        problems.append(f"kafka: {broker.open_consumers} consumers are open, 2 expected")
+    return problems
+
+
+def check_camera(config, outage: float, hz: float = 10):
+    """
+    Track a drone while the camera's PTZ endpoint goes down and comes back, the way the tracking loop does.
+    :return: a list of problems (empty if everything behaved)
+    """
+    problems = []
+    clock = FakeClock()
+    supervisor = new_supervisor(config, clock)
+    down_at = 10
+    endpoint = FakeEndpoint(clock, down_at, down_at + outage)
+    camera = Camera(config, actually_move=False, supervisor=supervisor)
+    camera.controller = FakePTZ(endpoint)
+
+    recovered_at = None
+    tick = 0
+    while clock() < down_at + outage + 2 * reconnect_limit(config):
+        if supervisor.available("camera-ptz"):  # Skip the tick while the PTZ is down, like dronetracker.py
+            camera.move_camera(POSITIONS[tick % 2])
+            if recovered_at is None and clock() >= endpoint.up_at and supervisor.healthy("camera-ptz"):
+                recovered_at = clock()
+        tick += 1
+        clock.sleep(1 / hz)
+
+    ticks_while_down = outage * hz
+    print(f"camera: down for {outage}s, {endpoint.calls_while_down} moves attempted over {int(ticks_while_down)}"
+          f" ticks while down, recovered {round(recovered_at - endpoint.up_at, 2) if recovered_at else None}s"
+          f" after the camera came back (health={supervisor.health()})")
+    if endpoint.calls_while_down > config["supervisor"]["failure_threshold"] + outage / reconnect_limit(config) + 1:
+        problems.append(f"camera: {endpoint.calls_while_down} moves while down is too many")
+    if recovered_at is None or recovered_at - endpoint.up_at > reconnect_limit(config):
+        problems.append("camera: took too long to recover once the camera was back")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--outage", type=float, default=60, help="how many seconds the endpoints are down for")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)  # The supervisor logs every failure, which would drown out the summary
+    with open(CONFIG_PATH) as config_file:
+        config = YAML().load(config_file)
+    problems = check_kafka(config, args.outage) + check_camera(config, args.outage)
+    if problems:
+        print("\nProblems:")
+        for problem in problems:
+            print("  " + problem)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+"""
+A local stand-in for the VAPIX endpoints the tracker uses, for testing the pooled controller without a camera.
+Set camera_login/ip to "127.0.0.1:8080" and camera/controller to "pooled" to point the tracker at it.
+
+Usage: python utils/fake_vapix.py [port] [ptz delay in seconds]
+"""
+import http.server
+import sys
+import threading
+import time
+import urllib.parse
+
+port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+ptz_delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0  # Pretend the camera is slow to accept moves
+
+lock = threading.Lock()
+connections = set()  # Client (ip, port) pairs, to show whether connections are being reused
+recordings = {}  # Recording id -> whether it is still recording
+requests_served = 0
+
+
+class FakeVapixHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Allow keep-alive
+
+    def reply(self, body: bytes, content_type: str = "text/xml", status: int = 200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        global requests_served
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        with lock:
+            connections.add(self.client_address)
+            requests_served += 1
+            print(f"{url.path} {query} (requests={requests_served}, connections={len(connections)})")
+
+        if url.path == "/axis-cgi/com/ptz.cgi":
+            time.sleep(ptz_delay)
+            self.send_response(204)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif url.path == "/axis-cgi/record/record.cgi":
+            with lock:
+                recording_id = time.strftime("%Y%m%d_%H%M%S_") + str(len(recordings))
+                recordings[recording_id] = True
+            self.reply(f'<root><record result="OK" recordingid="{recording_id}"/></root>'.encode("utf-8"))
+        elif url.path == "/axis-cgi/record/stop.cgi":
+            with lock:
+                result = "OK" if recordings.get(query.get("recordingid")) else "ERROR"
+                recordings[query.get("recordingid")] = False
+            self.reply(f'<root><stop result="{result}"/></root>'.encode("utf-8"))
+        elif url.path == "/axis-cgi/record/export/exportrecording.cgi":
+            if query.get("recordingid") not in recordings:
+                self.reply(b"recording not found", "text/plain", 404)
+                return
+            self.reply(b"\x1a\x45\xdf\xa3" + query["recordingid"].encode("utf-8"), "video/x-matroska")
+        else:
+            self.reply(b"not found", "text/plain", 404)
+
+    def log_message(self, *args):
+        return  # do_GET already prints a line per request
+
+
+server = http.server.ThreadingHTTPServer(("127.0.0.1", port), FakeVapixHandler)
+print(f"Fake VAPIX camera listening on 127.0.0.1:{port}")
+server.serve_forever()